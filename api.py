@@ -20,12 +20,23 @@
 networking and storage of VMs, and compute hosts on which they run)."""
 
 import base64
+import bisect
+import collections
+import contextlib
 import copy
 import functools
+import hashlib
 import re
 import string
+import sys
+import threading
 import uuid
 
+from eventlet import greenpool
+from eventlet import greenthread
+from eventlet import queue as eventlet_queue
+import netaddr
+from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
@@ -119,6 +130,161 @@ compute_opts = [
                     'in a local image being created on the hypervisor node. '
                     'Setting this to 0 means nova will allow only '
                     'boot from volume. A negative number means unlimited.'),
+    cfg.IntOpt('create_validation_workers',
+               default=8,
+               help='Maximum number of green threads used to run the '
+                    'independent external checks of a create request '
+                    '(availability zones, security groups, networks, '
+                    'kernel and ramdisk images, key pairs) concurrently. '
+                    'Setting this to 1 or less runs them one after '
+                    'another.'),
+    cfg.IntOpt('bulk_action_workers',
+               default=8,
+               help='Maximum number of green threads used to record '
+                    'instance actions for requests which act on many '
+                    'instances at once, such as multi-instance creates. '
+                    'Setting this to 1 or less records them one after '
+                    'another.'),
+    cfg.IntOpt('volume_cleanup_workers',
+               default=8,
+               help='Maximum number of green threads used to detach and '
+                    'delete the volumes of an instance which is deleted '
+                    'while its compute host is down. Setting this to 1 or '
+                    'less cleans them up one after another.'),
+    cfg.BoolOpt('defer_shelved_snapshot_delete',
+                default=False,
+                help='Delete the snapshot of a shelved instance in the '
+                     'background, retrying on failure, instead of waiting '
+                     'for the image service while the instance is deleted. '
+                     'Pending deletions are kept in memory only and are '
+                     'lost if the service stops.'),
+    cfg.IntOpt('shelved_snapshot_delete_retries',
+               default=5,
+               help='Number of times a deferred shelved snapshot deletion '
+                    'is retried before it is given up on.'),
+    cfg.IntOpt('shelved_snapshot_delete_retry_interval',
+               default=30,
+               help='Number of seconds to wait before retrying a deferred '
+                    'shelved snapshot deletion which failed.'),
+    cfg.BoolOpt('async_api_notifications',
+                default=False,
+                help='Send the notifications emitted by the compute API '
+                     'from a background green thread instead of from the '
+                     'thread serving the request. Notifications which '
+                     'don\'t fit in the queue are dropped and counted.'),
+    cfg.IntOpt('api_notification_queue_size',
+               default=1000,
+               help='Maximum number of notifications waiting to be sent '
+                    'when async_api_notifications is enabled.'),
+    cfg.IntOpt('api_notification_batch_size',
+               default=50,
+               help='Maximum number of queued notifications sent per '
+                    'wake-up of the background sender when '
+                    'async_api_notifications is enabled.'),
+    cfg.BoolOpt('allow_async_create',
+                default=False,
+                help='Allow callers of the compute API to ask for creates '
+                     'which return before the instances are written to the '
+                     'database. The build request is only kept in the memory '
+                     'of the API worker which accepted it: it is lost, along '
+                     'with its quota reservation until that expires, if the '
+                     'worker stops, and its status can only be polled on '
+                     'that same worker. Errors found while writing the '
+                     'instances, such as block device or server group quota '
+                     'errors, are only reported through that status. When '
+                     'disabled, asynchronous create requests are run '
+                     'synchronously.'),
+    cfg.IntOpt('async_create_workers',
+               default=16,
+               help='Maximum number of asynchronous create requests whose '
+                    'instances are written to the database and sent to '
+                    'the scheduler at the same time. Further asynchronous '
+                    'creates wait for a free worker before returning.'),
+    cfg.IntOpt('build_request_ttl',
+               default=3600,
+               help='Number of seconds the status of an asynchronous '
+                    'create request is kept for get_build_request().'),
+    cfg.IntOpt('build_request_max_records',
+               default=1000,
+               help='Maximum number of asynchronous create request '
+                    'statuses kept for get_build_request(). The oldest '
+                    'are forgotten first.'),
+    cfg.IntOpt('idempotency_key_ttl',
+               default=600,
+               help='Number of seconds the result of a create, rebuild, '
+                    'resize, snapshot or backup request made with an '
+                    'idempotency key is kept. A retry with the same key '
+                    'within that time gets the original result back '
+                    'instead of repeating the request. Setting this to 0 '
+                    'disables idempotency keys.'),
+    cfg.IntOpt('idempotency_key_cache_size',
+               default=10000,
+               help='Maximum number of idempotency key results kept in '
+                    'memory. The least recently used are forgotten first.'),
+    cfg.IntOpt('image_metadata_cache_size',
+               default=512,
+               help='Maximum number of image metadata entries the compute '
+                    'API keeps in memory for create, rebuild and snapshot '
+                    'requests. Setting this to 0 disables the cache.'),
+    cfg.IntOpt('image_metadata_cache_ttl',
+               default=60,
+               help='Number of seconds image metadata cached by the '
+                    'compute API stays valid. Setting this to 0 disables '
+                    'the cache.'),
+    cfg.IntOpt('instance_constraints_cache_size',
+               default=256,
+               help='Maximum number of NUMA topology and PCI request '
+                    'results, derived from a flavor and image, that the '
+                    'compute API keeps in memory. Entries expire with '
+                    'flavor_cache_ttl. Setting this to 0 disables the '
+                    'cache.'),
+    cfg.IntOpt('availability_zone_map_ttl',
+               default=60,
+               help='Number of seconds the compute API trusts its in-memory '
+                    'map of availability zones and their hosts before '
+                    'rebuilding it. Aggregate changes made through this '
+                    'service update the map straight away. Setting this to '
+                    '0 rebuilds the map for every request.'),
+    cfg.IntOpt('service_liveness_ttl',
+               default=10,
+               help='Number of seconds the compute API trusts its in-memory '
+                    'snapshot of the compute services when deleting '
+                    'instances or checking a host. Whether a service is up '
+                    'is still checked on every lookup, against the cached '
+                    'service. Paths which need the current state, such as '
+                    'evacuate, always read the service. Setting this to 0 '
+                    'reads it every time.'),
+    cfg.IntOpt('instance_list_page_size',
+               default=1000,
+               help='Number of instances fetched from the DB per query when '
+                    'iterating over a listing with get_all_iter().'),
+    cfg.IntOpt('ip_index_ttl',
+               default=0,
+               help='Number of seconds an index of the fixed IP addresses '
+                    'of the instances matching a set of filters is kept and '
+                    'used to answer ip and ip6 filters of instance listings. '
+                    'Instances updated since the index was built are '
+                    'checked directly, but an address change which only '
+                    'touches the network info cache can take this long to '
+                    'be found. Setting this to 0 disables the index and '
+                    'scans the network info of every instance instead.'),
+    cfg.IntOpt('ip_index_cache_size',
+               default=64,
+               help='Maximum number of sets of filters the compute API keeps '
+                    'an IP address index for.'),
+    cfg.IntOpt('flavor_cache_size',
+               default=256,
+               help='Maximum number of flavors the compute API keeps in '
+                    'memory. Setting this to 0 disables the cache.'),
+    cfg.IntOpt('flavor_cache_ttl',
+               default=300,
+               help='Number of seconds a flavor cached by the compute API '
+                    'stays valid. Setting this to 0 disables the cache.'),
+    cfg.FloatOpt('slow_create_log_threshold',
+                 default=0,
+                 help='Log the time spent in each stage of a create request '
+                      'which takes longer than this many seconds to '
+                      'return. Setting this to 0 disables the log.'),
 ]
 
 ephemeral_storage_encryption_group = cfg.OptGroup(
@@ -152,6 +318,7 @@ CONF.import_opt('enable', 'nova.cells.opts', group='cells')
 CONF.import_opt('default_ephemeral_format', 'nova.virt.driver')
 
 MAX_USERDATA_SIZE = 65535
+MAX_QUOTA_RESERVE_ATTEMPTS = 3
 RO_SECURITY_GROUPS = ['default']
 VIDEO_RAM = 'hw_video:ram_max_mb'
 
@@ -202,6 +369,79 @@ def check_instance_state(vm_state=None, task_state=(None,),
     return outer
 
 
+def _request_fingerprint(args, kwargs):
+    """Return a digest of the arguments of an API call.
+
+    Objects are identified by their uuid, flavorid or id where they have
+    one, so that state which changes as a request makes progress (such as
+    the task state of an instance) doesn't change the fingerprint.
+    """
+    def _identify(value):
+        if isinstance(value, obj_base.ObjectListBase):
+            return list(value.objects)
+        if isinstance(value, obj_base.NovaObject):
+            for field in ('uuid', 'flavorid', 'id'):
+                if field in value.fields and value.obj_attr_is_set(field):
+                    return '%s:%s' % (value.obj_name(), value[field])
+            return obj_base.obj_to_primitive(value)
+        return six.text_type(value)
+
+    dump = jsonutils.dumps([args, kwargs], sort_keys=True, default=_identify)
+    return hashlib.sha256(dump.encode('utf-8')).hexdigest()
+
+
+def idempotent(function):
+    """Decorator to let a mutating API call be retried safely.
+
+    When the caller passes an idempotency_key keyword argument, the result
+    of the first successful call with that key (for the same project, user,
+    method and, for instance actions, instance) is kept for
+    idempotency_key_ttl seconds and returned to any retry without doing
+    the work again. A retry whose other arguments differ from the first
+    call's is rejected with InvalidInput. Concurrent calls with the same
+    key wait for the first one to finish. Failed calls are not
+    remembered, so they can be retried.
+
+    This must be the outermost decorator, so that a retry doesn't trip
+    over the state checks of a request which has already been accepted.
+    """
+    @functools.wraps(function)
+    def wrapped(self, context, *args, **kwargs):
+        key = kwargs.pop('idempotency_key', None)
+        if key is None or not _IDEMPOTENT_RESULTS.enabled:
+            return function(self, context, *args, **kwargs)
+
+        instance = kwargs.get('instance')
+        params, other_kwargs = args, kwargs
+        if instance is None and args and isinstance(args[0],
+                                                    objects.Instance):
+            instance, params = args[0], args[1:]
+        elif instance is not None:
+            other_kwargs = {name: value for name, value in kwargs.items()
+                            if name != 'instance'}
+        instance_uuid = instance.uuid if instance is not None else None
+        fingerprint = _request_fingerprint(params, other_kwargs)
+
+        cache_key = (context.project_id, context.user_id,
+                     function.__name__, instance_uuid, key)
+        with lockutils.lock('compute-api-idempotency-%s' %
+                            '-'.join(map(six.text_type, cache_key))):
+            result = _IDEMPOTENT_RESULTS.get(cache_key)
+            if result is not None:
+                if result[0] != fingerprint:
+                    msg = (_('Idempotency key %s was already used for a '
+                             'different request') % key)
+                    raise exception.InvalidInput(reason=msg)
+                LOG.debug('Returning the result of an earlier %(method)s '
+                          'request with idempotency key %(key)s',
+                          {'method': function.__name__, 'key': key})
+                return result[1]
+            result = function(self, context, *args, **kwargs)
+            _IDEMPOTENT_RESULTS.set(cache_key, (fingerprint, result))
+            return result
+    return wrapped
+
+
 def check_instance_host(function):
     @functools.wraps(function)
     def wrapped(self, context, instance, *args, **kwargs):
@@ -266,6 +506,1042 @@ def _diff_dict(orig, new):
     return result
 
 
+_CACHES = {}
+
+
+def get_cache_stats():
+    """Return the hit/miss counters of the in-process compute API caches.
+
+    The result is a dict keyed by cache name.
+    """
+    return {name: cache.stats() for name, cache in _CACHES.items()}
+
+
+class _ExpiringLRUCache(object):
+    """A bounded, thread safe LRU cache whose entries expire after a TTL.
+
+    The size and TTL are read from the named config options on every
+    access, so they can be changed (or the cache disabled by setting
+    either of them to 0) without restarting the service.
+    """
+
+    def __init__(self, name, size_opt, ttl_opt):
+        self.name = name
+        self._size_opt = size_opt
+        self._ttl_opt = ttl_opt
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _CACHES[name] = self
+
+    @property
+    def enabled(self):
+        return (getattr(CONF, self._size_opt) > 0 and
+                getattr(CONF, self._ttl_opt) > 0)
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        now = timeutils.utcnow_ts()
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= now:
+                self.misses += 1
+                return default
+            # Re-insert to mark the entry as the most recently used one.
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        expires = timeutils.utcnow_ts() + getattr(CONF, self._ttl_opt)
+        size = getattr(CONF, self._size_opt)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        """Drop every entry for which predicate(key, value) is true."""
+        with self._lock:
+            for key, (expires, value) in list(self._data.items()):
+                if predicate(key, value):
+                    del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+_IDEMPOTENT_RESULTS = _ExpiringLRUCache('idempotency_key',
+                                        'idempotency_key_cache_size',
+                                        'idempotency_key_ttl')
+_IMAGE_METADATA_CACHE = _ExpiringLRUCache('image_metadata',
+                                          'image_metadata_cache_size',
+                                          'image_metadata_cache_ttl')
+_IMAGE_BDM_CACHE = _ExpiringLRUCache('image_block_device_mapping',
+                                     'image_metadata_cache_size',
+                                     'image_metadata_cache_ttl')
+
+
+class _CachingImageAPI(object):
+    """Read-through cache in front of image_api.get().
+
+    Entries are keyed on the project of the request, whether it was made
+    by an admin and the image reference. The image service shows admins
+    images which other users of their project can't see, so admin and
+    non-admin lookups never share an entry. Only active images are
+    cached, since the status of anything else is about to change. Callers
+    get their own copy of the metadata and are free to modify it.
+    """
+
+    def __init__(self, image_api):
+        self._image_api = image_api
+
+    def get(self, context, image_href):
+        key = (context.project_id, context.is_admin, image_href)
+        image = _IMAGE_METADATA_CACHE.get(key)
+        if image is None:
+            image = self._image_api.get(context, image_href)
+            if image.get('status') == 'active':
+                _IMAGE_METADATA_CACHE.set(key, image)
+        return copy.deepcopy(image)
+
+    @staticmethod
+    def invalidate(image_id):
+        """Forget everything cached about the given image."""
+        _IMAGE_METADATA_CACHE.invalidate_if(
+            lambda key, image: (key[-1] == image_id or
+                                image.get('id') == image_id))
+        _IMAGE_BDM_CACHE.invalidate_if(lambda key, bdms: key[0] == image_id)
+
+    @staticmethod
+    def clear():
+        _IMAGE_METADATA_CACHE.clear()
+        _IMAGE_BDM_CACHE.clear()
+
+
+class _FlavorCache(object):
+    """Process-wide cache of Flavor objects, extra_specs included.
+
+    Flavors are looked up by id or by flavorid. Non-admin lookups only see
+    public flavors and those shared with their project, so their entries
+    are kept apart per project. Callers get their own clone of the cached
+    object.
+    """
+
+    def __init__(self):
+        self._cache = _ExpiringLRUCache('flavor', 'flavor_cache_size',
+                                        'flavor_cache_ttl')
+
+    @staticmethod
+    def _scope(context):
+        return None if context.is_admin else context.project_id
+
+    def _get(self, key, loader, *args, **kwargs):
+        flavor = self._cache.get(key)
+        if flavor is None:
+            flavor = loader(*args, **kwargs)
+            # Load extra_specs now so that every later hit has them too.
+            flavor.extra_specs
+            self._cache.set(key, flavor)
+        return flavor.obj_clone()
+
+    def get_by_id(self, context, flavor_id):
+        """Cached version of objects.Flavor.get_by_id()."""
+        key = ('id', flavor_id, self._scope(context), context.read_deleted)
+        return self._get(key, objects.Flavor.get_by_id, context, flavor_id)
+
+    def get_by_flavor_id(self, context, flavorid, read_deleted=None):
+        """Cached version of objects.Flavor.get_by_flavor_id()."""
+        key = ('flavorid', flavorid, self._scope(context),
+               read_deleted or context.read_deleted)
+        return self._get(key, objects.Flavor.get_by_flavor_id, context,
+                         flavorid, read_deleted=read_deleted)
+
+    def invalidate(self, flavor=None):
+        """Forget the given flavor, or every flavor if none is given."""
+        if flavor is None:
+            self._cache.clear()
+            return
+        self._cache.invalidate_if(
+            lambda key, cached: (cached.id == flavor['id'] or
+                                 cached.flavorid == flavor['flavorid']))
+
+
+_FLAVORS = _FlavorCache()
+
+
+class _InstanceConstraintsCache(object):
+    """Memoize the NUMA topology and PCI requests derived for a flavor and
+    an image.
+
+    Both are pure functions of the flavor (including its extra specs) and
+    of the image properties, so they are keyed on those. Callers get their
+    own clone of the cached objects.
+    """
+
+    def __init__(self):
+        self._cache = _ExpiringLRUCache('instance_constraints',
+                                        'instance_constraints_cache_size',
+                                        'flavor_cache_ttl')
+
+    @staticmethod
+    def _flavor_key(flavor):
+        extra_specs = flavor.get('extra_specs') or {}
+        return (flavor['id'], flavor['vcpus'], flavor['memory_mb'],
+                tuple(sorted(extra_specs.items())))
+
+    @staticmethod
+    def _clone(value):
+        return value.obj_clone() if value is not None else None
+
+    def _get(self, key, func, *args):
+        result = self._cache.get(key)
+        if result is None:
+            result = (func(*args),)
+            self._cache.set(key, result)
+        return self._clone(result[0])
+
+    def numa_topology(self, flavor, image_meta):
+        """Memoized hardware.numa_get_constraints()."""
+        image_key = jsonutils.dumps(image_meta.get('properties', {}),
+                                    sort_keys=True)
+        key = ('numa', self._flavor_key(flavor), image_key)
+        return self._get(key, hardware.numa_get_constraints, flavor,
+                         image_meta)
+
+    def pci_requests(self, flavor):
+        """Memoized pci_request.get_pci_requests_from_flavor()."""
+        key = ('pci', self._flavor_key(flavor))
+        return self._get(key, pci_request.get_pci_requests_from_flavor,
+                         flavor)
+
+
+_INSTANCE_CONSTRAINTS = _InstanceConstraintsCache()
+
+
+def invalidate_flavor_cache(flavor=None):
+    """Drop a flavor from the compute API flavor cache.
+
+    Code which creates, destroys or changes the extra specs of a flavor
+    must call this so that the change is seen before the cached entry
+    expires. Without a flavor the whole cache is dropped.
+    """
+    _FLAVORS.invalidate(flavor)
+
+
+class _AvailabilityZoneMap(object):
+    """In-process map of the available availability zones and their hosts.
+
+    The map is built from a single availability_zones lookup and then kept
+    up to date incrementally by the AggregateAPI calls which move hosts
+    between zones. Changes made by other processes are picked up when the
+    map expires after availability_zone_map_ttl seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expires = 0
+        self._zone_hosts = {}
+        self._host_zones = {}
+
+    def _load(self, context):
+        zones, not_zones = availability_zones.get_availability_zones(
+            context, with_hosts=True)
+        zone_hosts = {}
+        host_zones = {}
+        for zone, hosts in zones:
+            zone_hosts.setdefault(zone, set()).update(hosts)
+            for host in hosts:
+                host_zones.setdefault(host, set()).add(zone)
+        with self._lock:
+            self._zone_hosts = zone_hosts
+            self._host_zones = host_zones
+            self._expires = (timeutils.utcnow_ts() +
+                             CONF.availability_zone_map_ttl)
+
+    def _ensure_loaded(self, context, refresh=False):
+        if refresh or self._expires <= timeutils.utcnow_ts():
+            self._load(context)
+
+    def available_zones(self, context, refresh=False):
+        """Return the set of zones which have enabled services."""
+        self._ensure_loaded(context, refresh=refresh)
+        return frozenset(self._zone_hosts)
+
+    def host_zones(self, context, host, refresh=False):
+        """Return the set of zones the given host is in."""
+        self._ensure_loaded(context, refresh=refresh)
+        return frozenset(self._host_zones.get(host, ()))
+
+    def move_hosts(self, hosts, zone):
+        """Record that the given hosts are now in the given zone.
+
+        Hosts the map doesn't know about have no enabled service, so they
+        don't make any zone available and are left out.
+        """
+        with self._lock:
+            for host in hosts:
+                if host not in self._host_zones:
+                    continue
+                for old_zone in self._host_zones.pop(host):
+                    old_hosts = self._zone_hosts.get(old_zone)
+                    if old_hosts is not None:
+                        old_hosts.discard(host)
+                        if not old_hosts:
+                            del self._zone_hosts[old_zone]
+                self._host_zones[host] = set([zone])
+                self._zone_hosts.setdefault(zone, set()).add(host)
+
+    def reset(self):
+        """Rebuild the whole map on the next lookup.
+
+        Used for changes, such as a host leaving its zone, whose outcome
+        can't be worked out without looking at the host's other
+        aggregates.
+        """
+        with self._lock:
+            self._expires = 0
+
+
+_AVAILABILITY_ZONES = _AvailabilityZoneMap()
+
+
+class _ServiceLiveness(object):
+    """In-process snapshot of the compute services.
+
+    The Service rows are loaded with a single query and reloaded once they
+    are older than service_liveness_ttl seconds. Whether a service is up
+    is still asked of the servicegroup API on every lookup, for that one
+    host only; with the DB driver that is just a comparison of the
+    service's last report time. Hosts missing from the snapshot, and
+    lookups made with force_refresh, read the service from the DB and
+    update the snapshot.
+
+    The services handed out are shared, so callers must not modify them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expires = 0
+        self._hosts = {}
+
+    def _load(self, context):
+        services = objects.ServiceList.get_all(context, set_zones=False)
+        hosts = {service.host: service for service in services
+                 if service.binary == 'nova-compute'}
+        with self._lock:
+            self._hosts = hosts
+            self._expires = (timeutils.utcnow_ts() +
+                             CONF.service_liveness_ttl)
+
+    def get(self, context, servicegroup_api, host, force_refresh=False):
+        """Return the compute service of host and whether it is up.
+
+        Raises ComputeHostNotFound if there is no compute service on host.
+        """
+        service = None
+        if not force_refresh and CONF.service_liveness_ttl > 0:
+            if self._expires <= timeutils.utcnow_ts():
+                self._load(context.elevated())
+            service = self._hosts.get(host)
+
+        if service is None:
+            service = objects.Service.get_by_compute_host(context.elevated(),
+                                                          host)
+            with self._lock:
+                self._hosts[host] = service
+        return service, servicegroup_api.service_is_up(service)
+
+    def reset(self):
+        """Reload the whole snapshot on the next lookup."""
+        with self._lock:
+            self._expires = 0
+            self._hosts = {}
+
+
+_SERVICES = _ServiceLiveness()
+
+
+def _ip_matcher(pattern):
+    """Return a callable telling whether an address matches an ip or ip6
+    filter.
+
+    The filters are regular expressions matched from the start of the
+    address, except that a CIDR such as 10.0.0.0/24 (which no address
+    could match as a regex) matches the addresses in that network.
+    """
+    if pattern is None:
+        return lambda address: False
+    pattern = str(pattern)
+    if '/' in pattern:
+        try:
+            network = netaddr.IPNetwork(pattern)
+        except (netaddr.AddrFormatError, ValueError):
+            pass
+        else:
+            return lambda address: netaddr.IPAddress(address) in network
+    return re.compile(pattern).match
+
+
+def _instance_has_ip(instance, ipv4_match, ipv6_match):
+    """Whether any fixed IP of instance satisfies the matcher of its IP
+    version.
+    """
+    nw_info = compute_utils.get_nw_info_for_instance(instance)
+    for vif in nw_info:
+        for fixed_ip in vif.fixed_ips():
+            address = fixed_ip.get('address')
+            if not address:
+                continue
+            version = fixed_ip.get('version')
+            if ((version == 4 and ipv4_match(address)) or
+                (version == 6 and ipv6_match(address))):
+                return True
+    return False
+
+
+# An ip or ip6 filter made of address characters and escaped dots only,
+# optionally anchored at the end, is a prefix (or exact) match on a
+# literal address and can be looked up in the index without a regex.
+_LITERAL_IP_FILTER = re.compile(r'^\^?((?:[0-9a-fA-F:]|\\\.)*)(\$?)$')
+
+
+class _AddressIndex(object):
+    """Fixed IP address -> instance UUIDs for one IP version."""
+
+    def __init__(self, owners):
+        self._owners = owners
+        self._addresses = sorted(owners)
+
+    def exact(self, address):
+        return set(self._owners.get(address, ()))
+
+    def prefix(self, prefix):
+        result = set()
+        index = bisect.bisect_left(self._addresses, prefix)
+        while (index < len(self._addresses) and
+               self._addresses[index].startswith(prefix)):
+            result.update(self._owners[self._addresses[index]])
+            index += 1
+        return result
+
+    def matching(self, match):
+        result = set()
+        for address in self._addresses:
+            if match(address):
+                result.update(self._owners[address])
+        return result
+
+    def search(self, pattern):
+        """Return the UUIDs of the instances with an address matching an
+        ip or ip6 filter.
+        """
+        literal = _LITERAL_IP_FILTER.match(str(pattern))
+        if literal is None:
+            return self.matching(_ip_matcher(pattern))
+        address = literal.group(1).replace('\\.', '.')
+        if literal.group(2):
+            return self.exact(address)
+        return self.prefix(address)
+
+
+class _IPIndex(object):
+    """Indexes of the fixed IP addresses of the instances matching a set
+    of filters, used to answer the ip and ip6 filters of get_all().
+
+    An index is built by reading the info caches of the matching instances
+    once and is then reused for ip_index_ttl seconds. Every search also
+    fetches the matching instances updated since the index was built
+    (with the changes-since filter) and checks their info caches directly
+    instead, so instances booted or renumbered since then are not
+    missed. Address changes which don't update the instance itself are
+    only seen once the index expires.
+    """
+
+    def __init__(self):
+        self._cache = _ExpiringLRUCache('ip_index', 'ip_index_cache_size',
+                                        'ip_index_ttl')
+
+    @property
+    def enabled(self):
+        return self._cache.enabled
+
+    @staticmethod
+    def _build(instances):
+        owners = {4: {}, 6: {}}
+        for instance in instances:
+            nw_info = compute_utils.get_nw_info_for_instance(instance)
+            for vif in nw_info:
+                for fixed_ip in vif.fixed_ips():
+                    address = fixed_ip.get('address')
+                    version = fixed_ip.get('version')
+                    if address and version in owners:
+                        owners[version].setdefault(address, set()).add(
+                            instance.uuid)
+        return {version: _AddressIndex(version_owners)
+                for version, version_owners in owners.items()}
+
+    def search(self, context, filters, loader):
+        """Return the UUIDs of the instances matching the ip and ip6
+        filters among those matching the other filters.
+
+        loader is called with a set of filters to fetch the instances
+        matching them, with their info caches.
+        """
+        other_filters = {key: value for key, value in filters.items()
+                         if key not in ('ip', 'ip6')}
+        key = (context.project_id, context.is_admin, context.read_deleted,
+               jsonutils.dumps(other_filters, sort_keys=True))
+        entry = self._cache.get(key)
+        if entry is None:
+            built_at = timeutils.utcnow()
+            entry = (built_at, self._build(loader(other_filters)))
+            self._cache.set(key, entry)
+            changed = []
+        else:
+            changed_filters = dict(other_filters)
+            changed_filters['changes-since'] = entry[0]
+            changed = loader(changed_filters)
+        index = entry[1]
+
+        uuids = set()
+        if filters.get('ip') is not None:
+            uuids |= index[4].search(filters['ip'])
+        if filters.get('ip6') is not None:
+            uuids |= index[6].search(filters['ip6'])
+
+        if changed:
+            ipv4_match = _ip_matcher(filters.get('ip'))
+            ipv6_match = _ip_matcher(filters.get('ip6'))
+            for instance in changed:
+                uuids.discard(instance.uuid)
+                if _instance_has_ip(instance, ipv4_match, ipv6_match):
+                    uuids.add(instance.uuid)
+        return uuids
+
+
+_IP_INDEX = _IPIndex()
+
+
+class _NotificationEmitter(object):
+    """Send compute API notifications off the request thread.
+
+    When async_api_notifications is enabled, notifications are put on a
+    bounded queue and sent, in order, by a single background green thread
+    which drains up to api_notification_batch_size of them per wake-up.
+    Objects and dicts passed to a notification are copied when it is
+    queued, so the payload reflects the moment the event happened. When
+    the queue is full the notification is dropped and counted rather than
+    making the request wait.
+
+    When async_api_notifications is disabled, notifications are sent
+    inline as before.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def _get_queue(self):
+        with self._lock:
+            if self._queue is None:
+                self._queue = eventlet_queue.LightQueue(
+                    CONF.api_notification_queue_size)
+                utils.spawn_n(self._run, self._queue)
+            return self._queue
+
+    def _run(self, queue):
+        while True:
+            batch = [queue.get()]
+            while len(batch) < CONF.api_notification_batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except eventlet_queue.Empty:
+                    break
+            for context, func, args, kwargs in batch:
+                try:
+                    context.update_store()
+                    func(*args, **kwargs)
+                    self.sent += 1
+                except Exception:
+                    self.failed += 1
+                    LOG.exception(_LE('Failed to send notification %s'),
+                                  func.__name__)
+
+    @staticmethod
+    def _freeze(value):
+        if isinstance(value, obj_base.NovaObject):
+            return value.obj_clone()
+        if isinstance(value, dict):
+            # Payload dicts are sometimes updated after the start event.
+            return dict(value)
+        return value
+
+    def emit(self, context, func, *args, **kwargs):
+        """Call func(*args, **kwargs) now, or queue it to be sent."""
+        if not CONF.async_api_notifications:
+            return func(*args, **kwargs)
+
+        args = [self._freeze(arg) for arg in args]
+        kwargs = {key: self._freeze(value)
+                  for key, value in kwargs.items()}
+        try:
+            self._get_queue().put_nowait((context, func, args, kwargs))
+        except eventlet_queue.Full:
+            self.dropped += 1
+            LOG.warning(_LW('Notification queue is full, dropping %s'),
+                        func.__name__)
+
+    def stats(self):
+        queue = self._queue
+        return {'queued': queue.qsize() if queue is not None else 0,
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped}
+
+
+_NOTIFICATIONS = _NotificationEmitter()
+
+
+# NOTE(hewh): The notification functions are looked up on every call rather
+# than bound once, so that patching them in their own modules still takes
+# effect here.
+def _send_update(context, *args, **kwargs):
+    _NOTIFICATIONS.emit(context, notifications.send_update,
+                        context, *args, **kwargs)
+
+
+def _send_update_with_states(context, *args, **kwargs):
+    _NOTIFICATIONS.emit(context, notifications.send_update_with_states,
+                        context, *args, **kwargs)
+
+
+def _notify_about_instance_usage(notifier, context, *args, **kwargs):
+    _NOTIFICATIONS.emit(context, compute_utils.notify_about_instance_usage,
+                        notifier, context, *args, **kwargs)
+
+
+def _notify_about_host_update(context, *args, **kwargs):
+    _NOTIFICATIONS.emit(context, compute_utils.notify_about_host_update,
+                        context, *args, **kwargs)
+
+
+def _notify_about_aggregate_update(context, *args, **kwargs):
+    _NOTIFICATIONS.emit(context, compute_utils.notify_about_aggregate_update,
+                        context, *args, **kwargs)
+
+
+def get_notification_stats():
+    """Return the queue depth and the sent/failed/dropped counters of the
+    compute API notification sender.
+    """
+    return _NOTIFICATIONS.stats()
+
+
+class _SnapshotReaper(object):
+    """Delete the snapshots of deleted shelved instances in the background.
+
+    Image ids are put on an unbounded queue drained by a single green
+    thread. A deletion which fails for any reason other than the image
+    being gone or off limits is retried up to
+    shelved_snapshot_delete_retries times, waiting
+    shelved_snapshot_delete_retry_interval seconds in between. The queue
+    lives in this process only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self.retrying = 0
+        self.deleted = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _get_queue(self):
+        with self._lock:
+            if self._queue is None:
+                self._queue = eventlet_queue.LightQueue()
+                utils.spawn_n(self._run, self._queue)
+            return self._queue
+
+    def _run(self, queue):
+        while True:
+            item = queue.get()
+            try:
+                self._delete(queue, *item)
+            except Exception:
+                LOG.exception(_LE('Unexpected error in the shelved snapshot '
+                                  'reaper'))
+
+    def _delete(self, queue, context, image_api, image_id, instance_uuid,
+                attempt):
+        context.update_store()
+        try:
+            image_api.delete(context, image_id)
+        except (exception.ImageNotFound,
+                exception.ImageNotAuthorized) as exc:
+            self.failed += 1
+            LOG.warning(_LW("Failed to delete snapshot "
+                            "from shelved instance (%s)."),
+                        exc.format_message(), instance_uuid=instance_uuid)
+        except Exception:
+            if attempt < CONF.shelved_snapshot_delete_retries:
+                self.retried += 1
+                self.retrying += 1
+                LOG.warning(_LW('Failed to delete snapshot %(image_id)s '
+                                'from shelved instance, retrying in '
+                                '%(interval)d seconds'),
+                            {'image_id': image_id,
+                             'interval':
+                                 CONF.shelved_snapshot_delete_retry_interval},
+                            instance_uuid=instance_uuid, exc_info=True)
+                greenthread.spawn_after(
+                    CONF.shelved_snapshot_delete_retry_interval,
+                    self._requeue, queue,
+                    (context, image_api, image_id, instance_uuid,
+                     attempt + 1))
+            else:
+                self.failed += 1
+                LOG.exception(_LE('Giving up on deleting snapshot %s from '
+                                  'shelved instance'), image_id,
+                              instance_uuid=instance_uuid)
+        else:
+            self.deleted += 1
+
+    def _requeue(self, queue, item):
+        self.retrying -= 1
+        queue.put(item)
+
+    def enqueue(self, context, image_api, image_id, instance_uuid):
+        """Queue the deletion of image_id, a snapshot of the shelved
+        instance instance_uuid.
+        """
+        _CachingImageAPI.invalidate(image_id)
+        self._get_queue().put((context, image_api, image_id, instance_uuid,
+                               0))
+
+    def stats(self):
+        queue = self._queue
+        return {'queued': queue.qsize() if queue is not None else 0,
+                'retrying': self.retrying,
+                'deleted': self.deleted,
+                'retried': self.retried,
+                'failed': self.failed}
+
+
+_SNAPSHOT_REAPER = _SnapshotReaper()
+
+
+def get_snapshot_reaper_stats():
+    """Return the queue depth and counters of the background deletion of
+    shelved instance snapshots.
+    """
+    return _SNAPSHOT_REAPER.stats()
+
+
+class _BuildRequests(object):
+    """Status of the asynchronous create requests of this process.
+
+    Each record is a small dict keyed by reservation id which tracks the
+    pre-allocated instance UUIDs and whether the background build has
+    finished. Records expire after build_request_ttl seconds.
+    """
+
+    BUILDING = 'building'
+    SCHEDULED = 'scheduled'
+    ERROR = 'error'
+
+    def __init__(self):
+        self._records = _ExpiringLRUCache('build_request',
+                                          'build_request_max_records',
+                                          'build_request_ttl')
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = greenpool.GreenPool(CONF.async_create_workers)
+            return self._pool
+
+    def start(self, context, reservation_id, instance_uuids, func, *args,
+              **kwargs):
+        """Record a new build request and run func in the background."""
+        record = {'reservation_id': reservation_id,
+                  'project_id': context.project_id,
+                  'instance_uuids': list(instance_uuids),
+                  'status': self.BUILDING,
+                  'error': None,
+                  'created_at': timeutils.utcnow()}
+        self._records.set(reservation_id, record)
+        # NOTE(hewh): The record only lives in this worker's memory, so log
+        # what was promised to the caller in case the worker goes away
+        # before the instances are written.
+        LOG.info(_LI('Accepted asynchronous create request %(reservation)s '
+                     'for instances %(uuids)s'),
+                 {'reservation': reservation_id,
+                  'uuids': ', '.join(instance_uuids)})
+        self._get_pool().spawn_n(self._run, context, record, func, args,
+                                 kwargs)
+
+    def _run(self, context, record, func, args, kwargs):
+        context.update_store()
+        try:
+            func(*args, **kwargs)
+        except Exception as exc:
+            LOG.exception(_LE('Asynchronous create of reservation %s '
+                              'failed'), record['reservation_id'])
+            record['error'] = six.text_type(exc)
+            record['status'] = self.ERROR
+        else:
+            record['status'] = self.SCHEDULED
+
+    def get(self, context, reservation_id):
+        record = self._records.get(reservation_id)
+        if record is None or (not context.is_admin and
+                              record['project_id'] != context.project_id):
+            return None
+        return dict(record)
+
+
+_BUILD_REQUESTS = _BuildRequests()
+
+
+# Upper bounds, in seconds, of the buckets of the stage timing histograms.
+# The last bucket holds everything slower than the last bound.
+_TIMING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)
+
+
+# Upper bounds of the max_count buckets the stage timings are tagged with.
+# A fixed set keeps the number of histograms bounded whatever max_count
+# callers send.
+_MAX_COUNT_BUCKETS = (1, 10, 50, 200)
+
+
+def _max_count_bucket(max_count):
+    """Return the label of the bucket max_count falls in, e.g. '2-10'."""
+    lower = 1
+    for upper in _MAX_COUNT_BUCKETS:
+        if max_count <= upper:
+            if lower == upper:
+                return str(upper)
+            return '%d-%d' % (lower, upper)
+        lower = upper + 1
+    return '>%d' % _MAX_COUNT_BUCKETS[-1]
+
+
+class _StageHistograms(object):
+    """Default stage timing sink, which keeps a histogram per stage and
+    max_count in memory.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def __call__(self, stage, elapsed, tags):
+        key = (stage, tags.get('max_count'))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = {'count': 0, 'sum': 0.0,
+                             'buckets': [0] * (len(_TIMING_BUCKETS) + 1)}
+                self._histograms[key] = histogram
+            histogram['count'] += 1
+            histogram['sum'] += elapsed
+            histogram['buckets'][
+                bisect.bisect_left(_TIMING_BUCKETS, elapsed)] += 1
+
+    def stats(self):
+        result = {}
+        with self._lock:
+            for (stage, max_count), histogram in self._histograms.items():
+                result.setdefault(stage, {})[max_count] = {
+                    'count': histogram['count'],
+                    'sum': histogram['sum'],
+                    'buckets': list(histogram['buckets'])}
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+_STAGE_HISTOGRAMS = _StageHistograms()
+_TIMING_SINKS = [_STAGE_HISTOGRAMS]
+
+
+def register_timing_sink(sink):
+    """Send the stage timings of create requests to sink as well.
+
+    sink is called as sink(stage, elapsed, tags) for every stage, where
+    elapsed is in seconds and tags is a dict which holds the bucket the
+    max_count of the request falls in (such as '2-10'). Sinks are called
+    inline, so they should be quick; errors raised by a sink are logged
+    and otherwise ignored.
+    """
+    if sink not in _TIMING_SINKS:
+        _TIMING_SINKS.append(sink)
+
+
+def unregister_timing_sink(sink):
+    if sink in _TIMING_SINKS:
+        _TIMING_SINKS.remove(sink)
+
+
+def get_timing_stats():
+    """Return the stage timing histograms of the create requests handled
+    by this process.
+
+    The result is keyed by stage and then by max_count bucket. Each histogram
+    has a count, the sum of the timings and the number of timings in each
+    bucket, the bounds of which are given under 'bucket_bounds'.
+    """
+    stats = _STAGE_HISTOGRAMS.stats()
+    stats['bucket_bounds'] = list(_TIMING_BUCKETS)
+    return stats
+
+
+class _StageTimer(object):
+    """Times the stages of a single request.
+
+    Every stage is handed to the registered timing sinks when it ends.
+    finish() records the time taken by the whole request and logs the
+    breakdown if it went over slow_create_log_threshold.
+    """
+
+    def __init__(self, request, **tags):
+        self._request = request
+        self._tags = tags
+        self._stages = []
+        self._watch = timeutils.StopWatch()
+        self._watch.start()
+
+    def _record(self, stage, elapsed):
+        self._stages.append((stage, elapsed))
+        for sink in list(_TIMING_SINKS):
+            try:
+                sink(stage, elapsed, self._tags)
+            except Exception:
+                LOG.exception(_LE('Timing sink %s failed'), sink)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        watch = timeutils.StopWatch()
+        watch.start()
+        try:
+            yield
+        finally:
+            self._record(stage, watch.elapsed())
+
+    def wrap(self, stage, func):
+        """Return a version of func whose calls are timed as stage."""
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with self.stage(stage):
+                return func(*args, **kwargs)
+        return wrapped
+
+    def finish(self):
+        elapsed = self._watch.elapsed()
+        self._record('total', elapsed)
+        threshold = CONF.slow_create_log_threshold
+        if threshold > 0 and elapsed > threshold:
+            LOG.warning(_LW('%(request)s took %(elapsed).3fs (%(tags)s): '
+                            '%(stages)s'),
+                        {'request': self._request, 'elapsed': elapsed,
+                         'tags': self._tags,
+                         'stages': ', '.join('%s=%.3fs' % stage
+                                             for stage in self._stages)})
+
+
+class _NullStageTimer(object):
+    """Stand-in for _StageTimer for callers which don't time anything."""
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        yield
+
+    def wrap(self, stage, func):
+        return func
+
+    def finish(self):
+        pass
+
+
+_NULL_TIMER = _NullStageTimer()
+
+
+class _OrderedFanout(object):
+    """Run independent blocking calls concurrently on a bounded pool.
+
+    Every call submitted with spawn() returns a callable which waits for
+    the result. Failures are re-raised by that callable rather than by the
+    green thread, so consuming the results in submission order reports the
+    same first error that running the calls one after another would have.
+
+    With a pool size of 1 or less nothing is spawned: each call runs when
+    its result is asked for, exactly as if it had been called inline.
+    """
+
+    def __init__(self, context, size):
+        self._context = context
+        self._pool = greenpool.GreenPool(size) if size > 1 else None
+
+    def _run(self, func, args, kwargs):
+        # Keep the request context in the thread local store so that log
+        # messages from the green thread are tagged with the request id.
+        self._context.update_store()
+        try:
+            return True, func(*args, **kwargs)
+        except Exception:
+            return False, sys.exc_info()
+
+    def spawn(self, func, *args, **kwargs):
+        if self._pool is None:
+            return functools.partial(func, *args, **kwargs)
+
+        thread = self._pool.spawn(self._run, func, args, kwargs)
+
+        def _wait():
+            succeeded, result = thread.wait()
+            if not succeeded:
+                six.reraise(*result)
+            return result
+        return _wait
+
+    def waitall(self):
+        if self._pool is not None:
+            self._pool.waitall()
+
+
 class API(base.Base):
     """API for interacting with the compute manager."""
 
@@ -273,6 +1549,7 @@ class API(base.Base):
                  security_group_api=None, skip_policy_check=False, **kwargs):
         self.skip_policy_check = skip_policy_check
         self.image_api = image_api or image.API()
+        self._image_cache = _CachingImageAPI(self.image_api)
         self.network_api = network_api or network.API(
             skip_policy_check=skip_policy_check)
         self.volume_api = volume_api or volume.API()
@@ -329,6 +1606,24 @@ class API(base.Base):
         objects.InstanceAction.action_start(context, instance.uuid,
                                             action, want_result=False)
 
+    def _record_action_start_many(self, context, instances, action):
+        """Record the start of the same action for many instances.
+
+        InstanceAction has no multi-row create, so the records are written
+        concurrently on a pool of up to bulk_action_workers green threads.
+        The first failure, in instance order, is re-raised once all of
+        the writes have finished.
+        """
+        fanout = _OrderedFanout(context, CONF.bulk_action_workers)
+        waits = [fanout.spawn(self._record_action_start, context, instance,
+                              action)
+                 for instance in instances]
+        try:
+            for wait in waits:
+                wait()
+        finally:
+            fanout.waitall()
+
     def _check_injected_file_quota(self, context, injected_files):
         """Enforce quota limits on injected files.
 
@@ -390,77 +1685,99 @@ class API(base.Base):
 
     def _check_num_instances_quota(self, context, instance_type, min_count,
                                    max_count):
-        """Enforce quota limits on number of instances created."""
+        """Enforce quota limits on number of instances created.
+
+        Reserves as many instances as possible, between min_count and
+        max_count. If max_count doesn't fit, the usages reported by the
+        failed reservation give the largest count which does, and that is
+        reserved instead. Further attempts are only made while other
+        requests keep shrinking the headroom, and never more than
+        MAX_QUOTA_RESERVE_ATTEMPTS times in all. If the request would still
+        fit when the attempts run out, or the headroom doesn't shrink, a
+        QuotaError asking the caller to retry is raised rather than
+        TooManyInstances.
+        """
 
         # Determine requested cores and ram
-        req_cores = max_count * instance_type['vcpus']
         vram_mb = int(instance_type.get('extra_specs', {}).get(VIDEO_RAM, 0))
-        req_ram = max_count * (instance_type['memory_mb'] + vram_mb)
+        count = max_count
+        for attempt in range(MAX_QUOTA_RESERVE_ATTEMPTS):
+            req_cores = count * instance_type['vcpus']
+            req_ram = count * (instance_type['memory_mb'] + vram_mb)
 
-        # Check the quota
-        try:
-            quotas = objects.Quotas(context)
-            quotas.reserve(instances=max_count,
-                           cores=req_cores, ram=req_ram)
-        except exception.OverQuota as exc:
-            # OK, we exceeded quota; let's figure out why...
-            quotas = exc.kwargs['quotas']
-            overs = exc.kwargs['overs']
-            usages = exc.kwargs['usages']
-            deltas = {'instances': max_count,
-                      'cores': req_cores, 'ram': req_ram}
-            headroom = self._get_headroom(quotas, usages, deltas)
-
-            allowed = headroom['instances']
-            # Reduce 'allowed' instances in line with the cores & ram headroom
-            if instance_type['vcpus']:
-                allowed = min(allowed,
-                              headroom['cores'] // instance_type['vcpus'])
-            if instance_type['memory_mb']:
-                allowed = min(allowed,
-                              headroom['ram'] // (instance_type['memory_mb'] +
-                                                  vram_mb))
-
-            # Convert to the appropriate exception message
-            if allowed <= 0:
-                msg = _("Cannot run any more instances of this type.")
-                allowed = 0
-            elif min_count <= allowed <= max_count:
-                # We're actually OK, but still need reservations
-                return self._check_num_instances_quota(context, instance_type,
-                                                       min_count, allowed)
-            else:
-                msg = (_("Can only run %s more instances of this type.") %
-                       allowed)
-
-            resource = overs[0]
-            used = quotas[resource] - headroom[resource]
-            total_allowed = quotas[resource]
-            overs = ','.join(overs)
-            params = {'overs': overs, 'pid': context.project_id,
-                      'min_count': min_count, 'max_count': max_count,
-                      'msg': msg}
-
-            if min_count == max_count:
-                LOG.debug(("%(overs)s quota exceeded for %(pid)s,"
-                           " tried to run %(min_count)d instances. "
-                           "%(msg)s"), params)
-            else:
-                LOG.debug(("%(overs)s quota exceeded for %(pid)s,"
-                           " tried to run between %(min_count)d and"
-                           " %(max_count)d instances. %(msg)s"),
-                          params)
-
-            num_instances = (str(min_count) if min_count == max_count else
-                "%s-%s" % (min_count, max_count))
-            requested = dict(instances=num_instances, cores=req_cores,
-                             ram=req_ram)
-            raise exception.TooManyInstances(overs=overs,
-                                             req=requested[resource],
-                                             used=used, allowed=total_allowed,
-                                             resource=resource)
-
-        return max_count, quotas
+            # Check the quota
+            try:
+                quotas = objects.Quotas(context)
+                quotas.reserve(instances=count,
+                               cores=req_cores, ram=req_ram)
+                return count, quotas
+            except exception.OverQuota as exc:
+                # OK, we exceeded quota; let's figure out why...
+                quotas = exc.kwargs['quotas']
+                overs = exc.kwargs['overs']
+                usages = exc.kwargs['usages']
+                deltas = {'instances': count,
+                          'cores': req_cores, 'ram': req_ram}
+                headroom = self._get_headroom(quotas, usages, deltas)
+
+                allowed = headroom['instances']
+                # Reduce 'allowed' instances in line with the cores & ram
+                # headroom
+                if instance_type['vcpus']:
+                    allowed = min(allowed,
+                                  headroom['cores'] // instance_type['vcpus'])
+                if instance_type['memory_mb']:
+                    allowed = min(allowed,
+                                  headroom['ram'] //
+                                  (instance_type['memory_mb'] + vram_mb))
+
+                if allowed < min_count:
+                    break
+                if (allowed < count and
+                        attempt + 1 < MAX_QUOTA_RESERVE_ATTEMPTS):
+                    # We're actually OK, but still need reservations
+                    count = allowed
+                    continue
+                # The request fits, but concurrent requests keep changing
+                # the usages under us.
+                msg = (_("Quota usage changed while reserving %d instances "
+                         "of this type, please retry.") % allowed)
+                raise exception.QuotaError(msg)
+
+        # Convert to the appropriate exception message
+        if allowed <= 0:
+            msg = _("Cannot run any more instances of this type.")
+            allowed = 0
+        else:
+            msg = (_("Can only run %s more instances of this type.") %
+                   allowed)
+
+        resource = overs[0]
+        used = quotas[resource] - headroom[resource]
+        total_allowed = quotas[resource]
+        overs = ','.join(overs)
+        params = {'overs': overs, 'pid': context.project_id,
+                  'min_count': min_count, 'max_count': count,
+                  'msg': msg}
+
+        if min_count == count:
+            LOG.debug(("%(overs)s quota exceeded for %(pid)s,"
+                       " tried to run %(min_count)d instances. "
+                       "%(msg)s"), params)
+        else:
+            LOG.debug(("%(overs)s quota exceeded for %(pid)s,"
+                       " tried to run between %(min_count)d and"
+                       " %(max_count)d instances. %(msg)s"),
+                      params)
+
+        num_instances = (str(min_count) if min_count == count else
+            "%s-%s" % (min_count, count))
+        requested = dict(instances=num_instances, cores=req_cores,
+                         ram=req_ram)
+        raise exception.TooManyInstances(overs=overs,
+                                         req=requested[resource],
+                                         used=used, allowed=total_allowed,
+                                         resource=resource)
 
     def _check_metadata_properties_quota(self, context, metadata=None):
         """Enforce quota limits on metadata properties."""
@@ -547,7 +1864,7 @@ class API(base.Base):
 
         # Verify kernel and ramdisk exist (fail-fast)
         if kernel_id is not None:
-            kernel_image = self.image_api.get(context, kernel_id)
+            kernel_image = self._image_cache.get(context, kernel_id)
             # kernel_id could have been a URI, not a UUID, so to keep behaviour
             # from before, which leaked that implementation detail out to the
             # caller, we return the image UUID of the kernel image and ramdisk
@@ -558,7 +1875,7 @@ class API(base.Base):
             kernel_id = kernel_image['id']
 
         if ramdisk_id is not None:
-            ramdisk_image = self.image_api.get(context, ramdisk_id)
+            ramdisk_image = self._image_cache.get(context, ramdisk_id)
             ramdisk_id = ramdisk_image['id']
 
         return kernel_id, ramdisk_id
@@ -617,23 +1934,41 @@ class API(base.Base):
             'auto_disk_config': auto_disk_config
         }
 
-    def _apply_instance_name_template(self, context, instance, index):
+    @staticmethod
+    def _get_instance_name_renderer():
+        """Return a function which renders
+        multi_instance_display_name_template for a dict of parameters.
+
+        The template is checked once here instead of once per instance. If
+        it can't be rendered the display name is left as it is.
+        """
+        template = CONF.multi_instance_display_name_template
+        try:
+            template % {'uuid': '', 'name': '', 'count': 1}
+        except (KeyError, TypeError):
+            LOG.exception(_LE('Failed to set instance name using '
+                              'multi_instance_display_name_template.'))
+            return lambda params: params['name']
+        return lambda params: template % params
+
+    def _apply_instance_name_template(self, context, instance, index,
+                                      render_name=None):
+        """Rename the instance using multi_instance_display_name_template.
+
+        The instance is not saved, so this must be called before the
+        instance is created for the new name to be written with it.
+        """
+        if render_name is None:
+            render_name = self._get_instance_name_renderer()
         params = {
             'uuid': instance.uuid,
             'name': instance.display_name,
             'count': index + 1,
         }
-        try:
-            new_name = (CONF.multi_instance_display_name_template %
-                        params)
-        except (KeyError, TypeError):
-            LOG.exception(_LE('Failed to set instance name using '
-                              'multi_instance_display_name_template.'))
-            new_name = instance.display_name
+        new_name = render_name(params)
         instance.display_name = new_name
         if not instance.get('hostname', None):
             instance.hostname = utils.sanitize_hostname(new_name)
-        instance.save()
         return instance
 
     def _check_config_drive(self, config_drive):
@@ -681,6 +2016,30 @@ class API(base.Base):
 
     def _get_image_defined_bdms(self, base_options, instance_type, image_meta,
                                 root_device_name):
+        image_id = image_meta.get('id')
+        if not image_id:
+            return self._build_image_defined_bdms(instance_type, image_meta,
+                                                  root_device_name)
+
+        # NOTE(hewh): The result only depends on the image contents,
+        # the root device name and the flavor's swap and ephemeral sizes,
+        # so it can be shared between requests booting the same image.
+        # Callers extend the list and may modify the dicts, hence the
+        # copies.
+        key = (image_id, image_meta.get('checksum'),
+               image_meta.get('updated_at'), root_device_name,
+               instance_type.get('swap', 0),
+               instance_type.get('ephemeral_gb', 0),
+               CONF.default_ephemeral_format)
+        image_defined_bdms = _IMAGE_BDM_CACHE.get(key)
+        if image_defined_bdms is None:
+            image_defined_bdms = self._build_image_defined_bdms(
+                instance_type, image_meta, root_device_name)
+            _IMAGE_BDM_CACHE.set(key, image_defined_bdms)
+        return [copy.copy(bdm) for bdm in image_defined_bdms]
+
+    def _build_image_defined_bdms(self, instance_type, image_meta,
+                                  root_device_name):
         image_properties = image_meta.get('properties', {})
 
         # Get the block device mappings defined by the image.
@@ -693,8 +2052,8 @@ class API(base.Base):
             image_defined_bdms = block_device.from_legacy_mapping(
                 image_defined_bdms, None, root_device_name)
         else:
-            image_defined_bdms = map(block_device.BlockDeviceDict,
-                                     image_defined_bdms)
+            image_defined_bdms = list(map(block_device.BlockDeviceDict,
+                                          image_defined_bdms))
 
         if image_mapping:
             image_defined_bdms += self._prepare_image_mapping(
@@ -762,7 +2121,7 @@ class API(base.Base):
         if not image_href:
             return None, {}
 
-        image = self.image_api.get(context, image_href)
+        image = self._image_cache.get(context, image_href)
         return image['id'], image
 
     def _checks_for_create_and_rebuild(self, context, image_id, image,
@@ -782,15 +2141,86 @@ class API(base.Base):
                                          access_ip_v4, access_ip_v6,
                                          requested_networks, config_drive,
                                          auto_disk_config, reservation_id,
-                                         max_count):
+                                         max_count, timer=_NULL_TIMER):
         """Verify all the input parameters regardless of the provisioning
         strategy being performed.
         """
-        if availability_zone:
-            available_zones = availability_zones.\
-                get_availability_zones(context.elevated(), True)
-            if forced_host is None and availability_zone not in \
-                    available_zones:
+        # NOTE(hewh): The checks below which call out to the DB or to
+        # other services do not depend on each other, so they are started
+        # together and their results are consumed in the original order.
+        # That way the first failure reported is the same one a serial
+        # run would have hit.
+        fanout = _OrderedFanout(context, CONF.create_validation_workers)
+
+        wait_for_zones = None
+        if availability_zone and forced_host is None:
+            wait_for_zones = fanout.spawn(
+                _AVAILABILITY_ZONES.available_zones, context.elevated())
+
+        wait_for_secgroups = fanout.spawn(self._check_requested_secgroups,
+                                          context, security_groups)
+
+        # Note:  max_count is the number of instances requested by the user,
+        # max_network_count is the maximum number of instances taking into
+        # account any network quotas
+        wait_for_networks = fanout.spawn(
+            timer.wrap('validate_networks', self._check_requested_networks),
+            context, requested_networks, max_count)
+
+        wait_for_kernel_and_ramdisk = fanout.spawn(
+            self._handle_kernel_and_ramdisk, context, kernel_id, ramdisk_id,
+            boot_meta)
+
+        wait_for_key_pair = None
+        if key_data is None and key_name is not None:
+            wait_for_key_pair = fanout.spawn(objects.KeyPair.get_by_name,
+                                             context, context.user_id,
+                                             key_name)
+
+        wait_for_pci_requests = fanout.spawn(self._get_pci_requests,
+                                             context, instance_type,
+                                             requested_networks)
+
+        try:
+            return self._build_base_options(context, instance_type,
+                boot_meta, image_href, image_id, display_name,
+                display_description, key_name, key_data, availability_zone,
+                user_data, metadata, injected_files, access_ip_v4,
+                access_ip_v6, config_drive, auto_disk_config, reservation_id,
+                wait_for_zones, wait_for_secgroups, wait_for_networks,
+                wait_for_kernel_and_ramdisk, wait_for_key_pair,
+                wait_for_pci_requests)
+        finally:
+            # Don't leave checks running on behalf of a request which has
+            # already failed.
+            fanout.waitall()
+
+    def _get_pci_requests(self, context, instance_type, requested_networks):
+        # PCI requests come from two sources: instance flavor and
+        # requested_networks. The first call in below returns an
+        # InstancePCIRequests object which is a list of InstancePCIRequest
+        # objects. The second call in below creates an InstancePCIRequest
+        # object for each SR-IOV port, and append it to the list in the
+        # InstancePCIRequests object
+        pci_request_info = _INSTANCE_CONSTRAINTS.pci_requests(instance_type)
+        self.network_api.create_pci_requests_for_sriov_ports(context,
+            pci_request_info, requested_networks)
+        return pci_request_info
+
+    def _build_base_options(self, context, instance_type, boot_meta,
+                            image_href, image_id, display_name,
+                            display_description, key_name, key_data,
+                            availability_zone, user_data, metadata,
+                            injected_files, access_ip_v4, access_ip_v6,
+                            config_drive, auto_disk_config, reservation_id,
+                            wait_for_zones, wait_for_secgroups,
+                            wait_for_networks, wait_for_kernel_and_ramdisk,
+                            wait_for_key_pair, wait_for_pci_requests):
+        """Collect the results of the checks started by
+        _validate_and_build_base_options() and build the base options.
+        """
+        if wait_for_zones is not None:
+            if availability_zone not in wait_for_zones():
                 msg = _('The requested availability zone is not available')
                 raise exception.InvalidRequest(msg)
 
@@ -813,44 +2243,27 @@ class API(base.Base):
         self._checks_for_create_and_rebuild(context, image_id, boot_meta,
                 instance_type, metadata, injected_files)
 
-        self._check_requested_secgroups(context, security_groups)
+        wait_for_secgroups()
 
-        # Note:  max_count is the number of instances requested by the user,
-        # max_network_count is the maximum number of instances taking into
-        # account any network quotas
-        max_network_count = self._check_requested_networks(context,
-                                     requested_networks, max_count)
+        max_network_count = wait_for_networks()
 
-        kernel_id, ramdisk_id = self._handle_kernel_and_ramdisk(
-                context, kernel_id, ramdisk_id, boot_meta)
+        kernel_id, ramdisk_id = wait_for_kernel_and_ramdisk()
 
         config_drive = self._check_config_drive(config_drive)
 
-        if key_data is None and key_name is not None:
-            key_pair = objects.KeyPair.get_by_name(context,
-                                                   context.user_id,
-                                                   key_name)
-            key_data = key_pair.public_key
+        if wait_for_key_pair is not None:
+            key_data = wait_for_key_pair().public_key
 
         root_device_name = block_device.prepend_dev(
                 block_device.properties_root_device_name(
                     boot_meta.get('properties', {})))
 
-        numa_topology = hardware.numa_get_constraints(
+        numa_topology = _INSTANCE_CONSTRAINTS.numa_topology(
                 instance_type, boot_meta)
 
         system_metadata = {}
 
-        # PCI requests come from two sources: instance flavor and
-        # requested_networks. The first call in below returns an
-        # InstancePCIRequests object which is a list of InstancePCIRequest
-        # objects. The second call in below creates an InstancePCIRequest
-        # object for each SR-IOV port, and append it to the list in the
-        # InstancePCIRequests object
-        pci_request_info = pci_request.get_pci_requests_from_flavor(
-            instance_type)
-        self.network_api.create_pci_requests_for_sriov_ports(context,
-            pci_request_info, requested_networks)
+        pci_request_info = wait_for_pci_requests()
 
         base_options = {
             'reservation_id': reservation_id,
@@ -907,44 +2320,61 @@ class API(base.Base):
     def _provision_instances(self, context, instance_type, min_count,
             max_count, base_options, boot_meta, security_groups,
             block_device_mapping, shutdown_terminate,
-            instance_group, check_server_group_quota):
+            instance_group, check_server_group_quota, reservation=None,
+            instance_uuids=None, timer=_NULL_TIMER):
         # Reserve quotas
-        num_instances, quotas = self._check_num_instances_quota(
-                context, instance_type, min_count, max_count)
+        if reservation is None:
+            with timer.stage('reserve_quota'):
+                reservation = self._check_num_instances_quota(
+                        context, instance_type, min_count, max_count)
+        num_instances, quotas = reservation
         LOG.debug("Going to run %s instances..." % num_instances)
         instances = []
         try:
+            if instance_group and check_server_group_quota:
+                # The whole batch joins the group, so check the quota for
+                # all of it at once before anything is written.
+                with timer.stage('check_server_group_quota'):
+                    count = objects.Quotas.count(context,
+                                                 'server_group_members',
+                                                 instance_group,
+                                                 context.user_id)
+                    try:
+                        objects.Quotas.limit_check(context,
+                                server_group_members=count + num_instances)
+                    except exception.OverQuota:
+                        msg = _("Quota exceeded, too many servers in "
+                                "group")
+                        raise exception.QuotaError(msg)
+
             for i in xrange(num_instances):
                 instance = objects.Instance(context=context)
                 instance.update(base_options)
-                instance = self.create_db_entry_for_new_instance(
-                        context, instance_type, boot_meta, instance,
-                        security_groups, block_device_mapping,
-                        num_instances, i, shutdown_terminate)
+                if instance_uuids:
+                    instance.uuid = instance_uuids[i]
                 instances.append(instance)
 
-                if instance_group:
-                    if check_server_group_quota:
-                        count = objects.Quotas.count(context,
-                                             'server_group_members',
-                                             instance_group,
-                                             context.user_id)
-                        try:
-                            objects.Quotas.limit_check(context,
-                                               server_group_members=count + 1)
-                        except exception.OverQuota:
-                            msg = _("Quota exceeded, too many servers in "
-                                    "group")
-                            raise exception.QuotaError(msg)
-
+            # NOTE(hewh): The whole batch is populated before anything is
+            # written, so the rows for every instance go out back to back
+            # and a failure part way through leaves only rows that the
+            # cleanup below knows about.
+            self._create_db_entries_for_new_instances(
+                    context, instance_type, boot_meta, instances,
+                    security_groups, block_device_mapping,
+                    shutdown_terminate, timer=timer)
+
+            if instance_group:
+                with timer.stage('db_add_group_members'):
                     objects.InstanceGroup.add_members(context,
-                                                      instance_group.uuid,
-                                                      [instance.uuid])
+                            instance_group.uuid,
+                            [instance.uuid for instance in instances])
 
-                # send a state update notification for the initial create to
-                # show it going from non-existent to BUILDING
-                notifications.send_update_with_states(context, instance, None,
-                        vm_states.BUILDING, None, None, service="api")
+            with timer.stage('notify_create'):
+                for instance in instances:
+                    # send a state update notification for the initial
+                    # create to show it going from non-existent to BUILDING
+                    _send_update_with_states(context, instance, None,
+                            vm_states.BUILDING, None, None, service="api")
 
         # In the case of any exceptions, attempt DB cleanup and rollback the
         # quota reservations.
@@ -960,7 +2390,8 @@ class API(base.Base):
                     quotas.rollback()
 
         # Commit the reservations
-        quotas.commit()
+        with timer.stage('commit_quota'):
+            quotas.commit()
         return instances
 
     def _get_bdm_image_metadata(self, context, block_device_mapping,
@@ -992,7 +2423,7 @@ class API(base.Base):
             if bdm.get('image_id'):
                 try:
                     image_id = bdm['image_id']
-                    image_meta = self.image_api.get(context, image_id)
+                    image_meta = self._image_cache.get(context, image_id)
                     return image_meta
                 except Exception:
                     raise exception.InvalidBDMImage(id=image_id)
@@ -1057,92 +2488,162 @@ class API(base.Base):
                block_device_mapping, auto_disk_config,
                reservation_id=None, scheduler_hints=None,
                legacy_bdm=True, shutdown_terminate=False,
-               check_server_group_quota=False):
+               check_server_group_quota=False, async_create=False):
         """Verify all the input parameters regardless of the provisioning
         strategy being performed and schedule the instance(s) for
         creation.
         """
-
-        # Normalize and setup some parameters
-        if reservation_id is None:
-            reservation_id = utils.generate_uid('r')
-        security_groups = security_groups or ['default']
-        min_count = min_count or 1
-        max_count = max_count or min_count
-        block_device_mapping = block_device_mapping or []
-        if not instance_type:
-            instance_type = flavors.get_default_flavor()
-
-        if image_href:
-            image_id, boot_meta = self._get_image(context, image_href)
-        else:
-            image_id = None
-            boot_meta = self._get_bdm_image_metadata(
-                context, block_device_mapping, legacy_bdm)
-
-        self._check_auto_disk_config(image=boot_meta,
-                                     auto_disk_config=auto_disk_config)
-
-        handle_az = self._handle_availability_zone
-        availability_zone, forced_host, forced_node = handle_az(context,
-                                                            availability_zone)
-
-        if not self.skip_policy_check and (forced_host or forced_node):
-            check_policy(context, 'create:forced_host', {})
-
-        base_options, max_net_count = self._validate_and_build_base_options(
-                context,
-                instance_type, boot_meta, image_href, image_id, kernel_id,
-                ramdisk_id, display_name, display_description,
-                key_name, key_data, security_groups, availability_zone,
-                forced_host, user_data, metadata, injected_files, access_ip_v4,
-                access_ip_v6, requested_networks, config_drive,
-                auto_disk_config, reservation_id, max_count)
-
-        # max_net_count is the maximum number of instances requested by the
-        # user adjusted for any network quota constraints, including
-        # considertaion of connections to each requested network
-        if max_net_count == 0:
-            raise exception.PortLimitExceeded()
-        elif max_net_count < max_count:
-            LOG.debug("max count reduced from %(max_count)d to "
-                      "%(max_net_count)d due to network port quota",
-                      {'max_count': max_count,
-                       'max_net_count': max_net_count})
-            max_count = max_net_count
-
-        block_device_mapping = self._check_and_transform_bdm(context,
-            base_options, instance_type, boot_meta, min_count, max_count,
-            block_device_mapping, legacy_bdm)
-
-        instance_group = self._get_requested_instance_group(context,
-                                   scheduler_hints, check_server_group_quota)
-
+        timer = _StageTimer('Create request',
+                            max_count=_max_count_bucket(max_count or
+                                                        min_count or 1))
+        try:
+            # Normalize and setup some parameters
+            if reservation_id is None:
+                reservation_id = utils.generate_uid('r')
+            security_groups = security_groups or ['default']
+            min_count = min_count or 1
+            max_count = max_count or min_count
+            block_device_mapping = block_device_mapping or []
+            if not instance_type:
+                instance_type = flavors.get_default_flavor()
+
+            with timer.stage('get_image'):
+                if image_href:
+                    image_id, boot_meta = self._get_image(context, image_href)
+                else:
+                    image_id = None
+                    boot_meta = self._get_bdm_image_metadata(
+                        context, block_device_mapping, legacy_bdm)
+
+            self._check_auto_disk_config(image=boot_meta,
+                                         auto_disk_config=auto_disk_config)
+
+            with timer.stage('availability_zone'):
+                handle_az = self._handle_availability_zone
+                availability_zone, forced_host, forced_node = handle_az(
+                    context, availability_zone)
+
+            if not self.skip_policy_check and (forced_host or forced_node):
+                check_policy(context, 'create:forced_host', {})
+
+            with timer.stage('base_options'):
+                base_options, max_net_count = (
+                    self._validate_and_build_base_options(context,
+                        instance_type, boot_meta, image_href, image_id,
+                        kernel_id, ramdisk_id, display_name,
+                        display_description, key_name, key_data,
+                        security_groups, availability_zone, forced_host,
+                        user_data, metadata, injected_files,
+                        access_ip_v4, access_ip_v6, requested_networks,
+                        config_drive, auto_disk_config, reservation_id,
+                        max_count, timer=timer))
+
+            # max_net_count is the maximum number of instances requested by
+            # the user adjusted for any network quota constraints, including
+            # considertaion of connections to each requested network
+            if max_net_count == 0:
+                raise exception.PortLimitExceeded()
+            elif max_net_count < max_count:
+                LOG.debug("max count reduced from %(max_count)d to "
+                          "%(max_net_count)d due to network port quota",
+                          {'max_count': max_count,
+                           'max_net_count': max_net_count})
+                max_count = max_net_count
+
+            with timer.stage('transform_bdm'):
+                block_device_mapping = self._check_and_transform_bdm(
+                    context, base_options, instance_type, boot_meta,
+                    min_count, max_count, block_device_mapping, legacy_bdm)
+
+            with timer.stage('get_instance_group'):
+                instance_group = self._get_requested_instance_group(context,
+                        scheduler_hints, check_server_group_quota)
+
+            build_args = (context, instance_type, min_count, max_count,
+                          base_options, boot_meta, security_groups,
+                          block_device_mapping, shutdown_terminate,
+                          instance_group, check_server_group_quota,
+                          scheduler_hints, forced_host, forced_node,
+                          admin_password, injected_files, requested_networks)
+
+            if not async_create:
+                instances = self._provision_and_build_instances(*build_args,
+                                                                timer=timer)
+                return (instances, reservation_id)
+
+            # NOTE(hewh): Quota is the one check left which the caller needs
+            # to hear about, so reserve it before returning. Everything else
+            # is written and scheduled in the background.
+            with timer.stage('reserve_quota'):
+                reservation = self._check_num_instances_quota(
+                        context, instance_type, min_count, max_count)
+            instance_uuids = [str(uuid.uuid4())
+                              for i in xrange(reservation[0])]
+            try:
+                _BUILD_REQUESTS.start(context, reservation_id, instance_uuids,
+                                      self._provision_and_build_instances,
+                                      *build_args, reservation=reservation,
+                                      instance_uuids=instance_uuids,
+                                      timer=timer)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    reservation[1].rollback()
+            return (instance_uuids, reservation_id)
+        finally:
+            # NOTE(hewh): With async_create this only covers the part of
+            # the request the caller waits for. The stages run in the
+            # background still go to the sinks as they end.
+            timer.finish()
+
+    def _provision_and_build_instances(self, context, instance_type,
+            min_count, max_count, base_options, boot_meta, security_groups,
+            block_device_mapping, shutdown_terminate, instance_group,
+            check_server_group_quota, scheduler_hints, forced_host,
+            forced_node, admin_password, injected_files, requested_networks,
+            reservation=None, instance_uuids=None, timer=_NULL_TIMER):
+        """Write the new instances to the DB and send them to the
+        scheduler.
+        """
         instances = self._provision_instances(context, instance_type,
                 min_count, max_count, base_options, boot_meta, security_groups,
                 block_device_mapping, shutdown_terminate,
-                instance_group, check_server_group_quota)
+                instance_group, check_server_group_quota,
+                reservation=reservation, instance_uuids=instance_uuids,
+                timer=timer)
 
         filter_properties = self._build_filter_properties(context,
                 scheduler_hints, forced_host,
                 forced_node, instance_type,
                 base_options.get('pci_requests'))
 
-        for instance in instances:
-            self._record_action_start(context, instance,
-                                      instance_actions.CREATE)
+        with timer.stage('record_actions'):
+            self._record_action_start_many(context, instances,
+                                           instance_actions.CREATE)
+
+        with timer.stage('build_instances'):
+            self.compute_task_api.build_instances(context,
+                    instances=instances, image=boot_meta,
+                    filter_properties=filter_properties,
+                    admin_password=admin_password,
+                    injected_files=injected_files,
+                    requested_networks=requested_networks,
+                    security_groups=security_groups,
+                    block_device_mapping=block_device_mapping,
+                    legacy_bdm=False)
+
+        return instances
 
-        self.compute_task_api.build_instances(context,
-                instances=instances, image=boot_meta,
-                filter_properties=filter_properties,
-                admin_password=admin_password,
-                injected_files=injected_files,
-                requested_networks=requested_networks,
-                security_groups=security_groups,
-                block_device_mapping=block_device_mapping,
-                legacy_bdm=False)
+    def get_build_request(self, context, reservation_id):
+        """Return the status of an asynchronous create request.
 
-        return (instances, reservation_id)
+        The result is a dict with the reservation id, the instance UUIDs
+        handed out when the request was accepted, a status of 'building',
+        'scheduled' or 'error', and the error message if the build failed.
+        None is returned for unknown or expired reservations, for requests
+        made by another project and for requests accepted by another API
+        worker, since the status is only kept in memory.
+        """
+        return _BUILD_REQUESTS.get(context, reservation_id)
 
     @staticmethod
     def _volume_size(instance_type, bdm):
@@ -1193,36 +2694,73 @@ class API(base.Base):
 
         return prepared_mappings
 
-    def _create_block_device_mapping(self, instance_type, instance_uuid,
-                                     block_device_mapping):
+    def _create_block_device_mapping(self, context, instance_type,
+                                     instance_uuid, block_device_mapping):
         """Create the BlockDeviceMapping objects in the db.
 
-        This method makes a copy of the list in order to avoid using the same
-        id field in case this is called for multiple instances.
+        The objects in the list are left untouched so that the same list
+        can be used for multiple instances.
         """
         LOG.debug("block_device_mapping %s", block_device_mapping,
                   instance_uuid=instance_uuid)
-        instance_block_device_mapping = copy.deepcopy(block_device_mapping)
-        for bdm in instance_block_device_mapping:
-            bdm.volume_size = self._volume_size(instance_type, bdm)
-            if bdm.volume_size == 0:
+        self._create_block_device_mappings(context, instance_type,
+                                           [instance_uuid],
+                                           block_device_mapping)
+
+    def _create_block_device_mappings(self, context, instance_type,
+                                      instance_uuids, block_device_mapping):
+        """Create the BlockDeviceMapping objects of a batch of new
+        instances in the db.
+
+        The field values of each requested mapping, including its volume
+        size, are worked out once for the whole batch. Every instance then
+        gets plain new objects built from those values instead of a deep
+        copy of the whole list. Since the instances are new there is
+        nothing to update, so each row is a single insert.
+        """
+        templates = []
+        for bdm in block_device_mapping:
+            volume_size = self._volume_size(instance_type, bdm)
+            if volume_size == 0:
                 continue
 
-            bdm.instance_uuid = instance_uuid
-            bdm.update_or_create()
-
-    def _validate_bdm(self, context, instance, instance_type, all_mappings):
+            values = {field: bdm[field] for field in bdm.fields
+                      if field not in ('id', 'instance', 'instance_uuid')
+                      and bdm.obj_attr_is_set(field)}
+            values['volume_size'] = volume_size
+            templates.append(values)
+
+        for instance_uuid in instance_uuids:
+            for values in templates:
+                instance_bdm = objects.BlockDeviceMapping(context=context,
+                                                          **values)
+                instance_bdm.instance_uuid = instance_uuid
+                instance_bdm.create()
+
+    def _validate_bdm(self, context, instance, instance_type, all_mappings,
+                      validate_request=True):
+        """Validate the block device mappings of a new instance.
+
+        :param validate_request: whether to run the checks which only depend
+                                 on the request (boot order, images,
+                                 snapshots and disk sizes). When the same
+                                 mappings are used for several instances
+                                 these only need to pass once; the volume
+                                 checks depend on the instance and always
+                                 run.
+        """
         def _subsequent_list(l):
             return all(el + 1 == l[i + 1] for i, el in enumerate(l[:-1]))
 
-        # Make sure that the boot indexes make sense
-        boot_indexes = sorted([bdm.boot_index
-                               for bdm in all_mappings
-                               if bdm.boot_index is not None
-                               and bdm.boot_index >= 0])
+        if validate_request:
+            # Make sure that the boot indexes make sense
+            boot_indexes = sorted([bdm.boot_index
+                                   for bdm in all_mappings
+                                   if bdm.boot_index is not None
+                                   and bdm.boot_index >= 0])
 
-        if 0 not in boot_indexes or not _subsequent_list(boot_indexes):
-            raise exception.InvalidBDMBootSequence()
+            if 0 not in boot_indexes or not _subsequent_list(boot_indexes):
+                raise exception.InvalidBDMBootSequence()
 
         for bdm in all_mappings:
             # NOTE(vish): For now, just make sure the volumes are accessible.
@@ -1233,6 +2771,8 @@ class API(base.Base):
             image_id = bdm.image_id
             if (image_id is not None and
                     image_id != instance.get('image_ref')):
+                if not validate_request:
+                    continue
                 try:
                     self._get_image(context, image_id)
                 except Exception:
@@ -1255,6 +2795,8 @@ class API(base.Base):
                 except Exception:
                     raise exception.InvalidBDMVolume(id=volume_id)
             elif snapshot_id is not None:
+                if not validate_request:
+                    continue
                 try:
                     self.volume_api.get_snapshot(context, snapshot_id)
                 except exception.CinderConnectionFailed:
@@ -1262,6 +2804,9 @@ class API(base.Base):
                 except Exception:
                     raise exception.InvalidBDMSnapshot(id=snapshot_id)
 
+        if not validate_request:
+            return
+
         ephemeral_size = sum(bdm.volume_size or 0
                 for bdm in all_mappings
                 if block_device.new_format_is_ephemeral(bdm))
@@ -1375,11 +2920,6 @@ class API(base.Base):
 
         self._populate_instance_names(instance, num_instances)
 
-        instance.shutdown_terminate = shutdown_terminate
-
-        self.security_group_api.ensure_default(context)
-        instance.create()
-
         if num_instances > 1:
             # NOTE(russellb) We wait until this spot to handle
             # multi_instance_display_name_template, because we need
@@ -1387,6 +2927,11 @@ class API(base.Base):
             instance = self._apply_instance_name_template(context, instance,
                                                           index)
 
+        instance.shutdown_terminate = shutdown_terminate
+
+        self.security_group_api.ensure_default(context)
+        instance.create()
+
         # NOTE (ndipanov): This can now raise exceptions but the instance
         #                  has been created, so delete it and re-raise so
         #                  that other cleanup can happen.
@@ -1399,10 +2944,66 @@ class API(base.Base):
                 instance.destroy()
 
         self._create_block_device_mapping(
-                instance_type, instance.uuid, block_device_mapping)
+                context, instance_type, instance.uuid, block_device_mapping)
 
         return instance
 
+    def _create_db_entries_for_new_instances(self, context, instance_type,
+            image, instances, security_groups, block_device_mapping,
+            shutdown_terminate=False, timer=_NULL_TIMER):
+        """Create the DB entries for a batch of new instances.
+
+        This is the multi-instance counterpart of
+        create_db_entry_for_new_instance(). Every instance is populated
+        before the first row is written and the per-request work (such as
+        making sure the default security group exists) is only done once
+        for the whole batch.
+
+        Instances which were written before a failure are left for the
+        caller to destroy; instances which were never written raise
+        ObjectActionError on destroy(), which the caller already ignores.
+        """
+        num_instances = len(instances)
+        if num_instances > 1:
+            render_name = self._get_instance_name_renderer()
+        for index, instance in enumerate(instances):
+            self._populate_instance_for_create(context, instance, image,
+                                               index, security_groups,
+                                               instance_type)
+            self._populate_instance_names(instance, num_instances)
+            if num_instances > 1:
+                # NOTE(hewh): The UUID is generated when the instance is
+                # populated, so the template can be applied before the
+                # instance is written and it only has to be written once.
+                self._apply_instance_name_template(context, instance, index,
+                                                   render_name)
+            instance.shutdown_terminate = shutdown_terminate
+
+            # NOTE(hewh): The mappings are the same for every instance, so
+            # the checks which only depend on the request (and which fetch
+            # the images and snapshots) run for the first one only. None
+            # of the checks need the instance to be in the DB, so a bad
+            # request fails before anything is written.
+            self._validate_bdm(context, instance, instance_type,
+                               block_device_mapping,
+                               validate_request=(index == 0))
+
+        with timer.stage('ensure_default_security_group'):
+            self.security_group_api.ensure_default(context)
+
+        with timer.stage('db_create_instances'):
+            for instance in instances:
+                instance.create()
+
+        LOG.debug("block_device_mapping %s", block_device_mapping)
+        with timer.stage('db_create_block_device_mappings'):
+            self._create_block_device_mappings(
+                    context, instance_type,
+                    [instance.uuid for instance in instances],
+                    block_device_mapping)
+
+        return instances
+
     def _check_create_policies(self, context, availability_zone,
             requested_networks, block_device_mapping):
         """Check policies for create()."""
@@ -1436,6 +3037,7 @@ class API(base.Base):
                         "is specified.")
                 raise exception.InvalidFixedIpAndMaxCountRequest(reason=msg)
 
+    @idempotent
     @hooks.add_hook("create_instance")
     def create(self, context, instance_type,
                image_href, kernel_id=None, ramdisk_id=None,
@@ -1447,12 +3049,20 @@ class API(base.Base):
                block_device_mapping=None, access_ip_v4=None,
                access_ip_v6=None, requested_networks=None, config_drive=None,
                auto_disk_config=None, scheduler_hints=None, legacy_bdm=True,
-               shutdown_terminate=False, check_server_group_quota=False):
+               shutdown_terminate=False, check_server_group_quota=False,
+               async_create=False):
         """Provision instances, sending instance information to the
         scheduler.  The scheduler will determine where the instance(s)
         go and will handle creating the DB entries.
 
         Returns a tuple of (instances, reservation_id)
+
+        If async_create is True and the allow_async_create option is
+        enabled, the request is validated and the quota reserved, but the
+        instances are written and scheduled in the background. The
+        returned tuple is then (instance_uuids, reservation_id) and
+        get_build_request(), on the same API worker, reports on the
+        progress. Otherwise async_create is ignored.
         """
 
         self._check_create_policies(context, availability_zone,
@@ -1478,7 +3088,9 @@ class API(base.Base):
                        scheduler_hints=scheduler_hints,
                        legacy_bdm=legacy_bdm,
                        shutdown_terminate=shutdown_terminate,
-                       check_server_group_quota=check_server_group_quota)
+                       check_server_group_quota=check_server_group_quota,
+                       async_create=(async_create and
+                                     CONF.allow_async_create))
 
     @wrap_check_policy
     def update(self, context, instance, **kwargs):
@@ -1500,8 +3112,8 @@ class API(base.Base):
         # if task or vm state changed
         old_ref, instance_ref = self.db.instance_update_and_get_original(
                                   context, instance.uuid, kwargs)
-        notifications.send_update(context, old_ref,
-                                  instance_ref, service="api")
+        _send_update(context, old_ref,
+                     instance_ref, service="api")
 
         return dict(old_ref.iteritems()), dict(instance_ref.iteritems())
 
@@ -1546,17 +3158,11 @@ class API(base.Base):
             LOG.info(_LI("Working on deleting snapshot %s "
                          "from shelved instance..."),
                      snapshot_id, instance=instance)
-            try:
-                self.image_api.delete(context, snapshot_id)
-            except (exception.ImageNotFound,
-                    exception.ImageNotAuthorized) as exc:
-                LOG.warning(_LW("Failed to delete snapshot "
-                                "from shelved instance (%s)."),
-                            exc.format_message(), instance=instance)
-            except Exception:
-                LOG.exception(_LE("Something wrong happened when trying to "
-                                  "delete snapshot from shelved instance."),
-                              instance=instance)
+            if CONF.defer_shelved_snapshot_delete and snapshot_id:
+                _SNAPSHOT_REAPER.enqueue(context, self.image_api, snapshot_id,
+                                         instance.uuid)
+            else:
+                self._delete_shelved_snapshot(context, instance, snapshot_id)
 
         original_task_state = instance.task_state
         quotas = None
@@ -1587,11 +3193,11 @@ class API(base.Base):
                                  == vm_states.SHELVED_OFFLOADED)
             if not instance.host and not shelved_offloaded:
                 try:
-                    compute_utils.notify_about_instance_usage(
+                    _notify_about_instance_usage(
                             self.notifier, context, instance,
                             "%s.start" % delete_type)
                     instance.destroy()
-                    compute_utils.notify_about_instance_usage(
+                    _notify_about_instance_usage(
                             self.notifier, context, instance,
                             "%s.end" % delete_type,
                             system_metadata=instance.system_metadata)
@@ -1606,10 +3212,10 @@ class API(base.Base):
             is_local_delete = True
             try:
                 if not shelved_offloaded:
-                    service = objects.Service.get_by_compute_host(
-                        context.elevated(), instance.host)
-                    is_local_delete = not self.servicegroup_api.service_is_up(
-                        service)
+                    service, is_up = _SERVICES.get(context,
+                                                   self.servicegroup_api,
+                                                   instance.host)
+                    is_local_delete = not is_up
                 if not is_local_delete:
                     if original_task_state in (task_states.DELETING,
                                                   task_states.SOFT_DELETING):
@@ -1650,6 +3256,20 @@ class API(base.Base):
                 if quotas:
                     quotas.rollback()
 
+    def _delete_shelved_snapshot(self, context, instance, snapshot_id):
+        try:
+            self._image_cache.invalidate(snapshot_id)
+            self.image_api.delete(context, snapshot_id)
+        except (exception.ImageNotFound,
+                exception.ImageNotAuthorized) as exc:
+            LOG.warning(_LW("Failed to delete snapshot "
+                            "from shelved instance (%s)."),
+                        exc.format_message(), instance=instance)
+        except Exception:
+            LOG.exception(_LE("Something wrong happened when trying to "
+                              "delete snapshot from shelved instance."),
+                          instance=instance)
+
     def _confirm_resize_on_deleting(self, context, instance):
         # If in the middle of a resize, use confirm_resize to
         # ensure the original instance is cleaned up too
@@ -1719,7 +3339,8 @@ class API(base.Base):
                         migration.new_instance_type_id):
                 old_inst_type_id = migration.old_instance_type_id
                 try:
-                    old_inst_type = flavors.get_flavor(old_inst_type_id)
+                    old_inst_type = _FLAVORS.get_by_id(context.elevated(),
+                                                       old_inst_type_id)
                 except exception.FlavorNotFound:
                     LOG.warning(_LW("Flavor %d not found"), old_inst_type_id)
                     pass
@@ -1748,7 +3369,7 @@ class API(base.Base):
             LOG.warning(_LW("instance's host %s is down, deleting from "
                             "database"), instance.host, instance=instance)
         instance.info_cache.delete()
-        compute_utils.notify_about_instance_usage(
+        _notify_about_instance_usage(
             self.notifier, context, instance, "%s.start" % delete_type)
 
         elevated = context.elevated()
@@ -1772,31 +3393,44 @@ class API(base.Base):
                 instance.host = orig_host
 
         # cleanup volumes
+        # NOTE(hewh): Each volume takes a few calls to Cinder, and they don't
+        # depend on the other volumes, so the volumes are cleaned up
+        # concurrently. Failures are logged and ignored per volume.
+        fanout = _OrderedFanout(context, CONF.volume_cleanup_workers)
+        waits = [fanout.spawn(self._local_cleanup_volume, context, elevated,
+                              instance, bdm)
+                 for bdm in bdms if bdm.is_volume]
+        try:
+            for wait in waits:
+                wait()
+        finally:
+            fanout.waitall()
         for bdm in bdms:
-            if bdm.is_volume:
-                # NOTE(vish): We don't have access to correct volume
-                #             connector info, so just pass a fake
-                #             connector. This can be improved when we
-                #             expose get_volume_connector to rpc.
-                connector = {'ip': '127.0.0.1', 'initiator': 'iqn.fake'}
-                try:
-                    self.volume_api.terminate_connection(context,
-                                                         bdm.volume_id,
-                                                         connector)
-                    self.volume_api.detach(elevated, bdm.volume_id)
-                    if bdm.delete_on_termination:
-                        self.volume_api.delete(context, bdm.volume_id)
-                except Exception as exc:
-                    err_str = _LW("Ignoring volume cleanup failure due to %s")
-                    LOG.warn(err_str % exc, instance=instance)
             bdm.destroy()
         cb(context, instance, bdms, local=True)
         sys_meta = instance.system_metadata
         instance.destroy()
-        compute_utils.notify_about_instance_usage(
+        _notify_about_instance_usage(
             self.notifier, context, instance, "%s.end" % delete_type,
             system_metadata=sys_meta)
 
+    def _local_cleanup_volume(self, context, elevated, instance, bdm):
+        # NOTE(vish): We don't have access to correct volume
+        #             connector info, so just pass a fake
+        #             connector. This can be improved when we
+        #             expose get_volume_connector to rpc.
+        connector = {'ip': '127.0.0.1', 'initiator': 'iqn.fake'}
+        try:
+            self.volume_api.terminate_connection(context,
+                                                 bdm.volume_id,
+                                                 connector)
+            self.volume_api.detach(elevated, bdm.volume_id)
+            if bdm.delete_on_termination:
+                self.volume_api.delete(context, bdm.volume_id)
+        except Exception as exc:
+            err_str = _LW("Ignoring volume cleanup failure due to %s")
+            LOG.warn(err_str % exc, instance=instance)
+
     def _do_delete(self, context, instance, bdms, reservations=None,
                    local=False):
         if local:
@@ -1848,6 +3482,138 @@ class API(base.Base):
         LOG.debug("Going to try to terminate instance", instance=instance)
         self._delete_instance(context, instance)
 
+    @staticmethod
+    def _can_delete_in_batch(instance):
+        """Whether deleting instance is nothing more than a terminate cast
+        to its host and a quota decrement.
+        """
+        return (instance.host and
+                instance.vm_state not in (vm_states.SHELVED,
+                                          vm_states.SHELVED_OFFLOADED,
+                                          vm_states.RESIZED,
+                                          vm_states.SOFT_DELETED) and
+                instance.task_state not in (task_states.DELETING,
+                                            task_states.SOFT_DELETING,
+                                            task_states.RESIZE_MIGRATED,
+                                            task_states.RESIZE_FINISH))
+
+    def delete_many(self, context, instances):
+        """Terminate a batch of instances.
+
+        Every instance is checked the same way delete() checks it before
+        any of them is touched. Instances which are running on a compute
+        host that is up are deleted together: the compute service of each
+        host is looked up once, their block device mappings are fetched
+        concurrently and their instance actions are recorded together. As
+        with delete(), every terminate cast carries its own quota
+        reservation, which the compute manager commits or rolls back. The
+        casts are sent host by host.
+
+        Anything else (instances without a host, on a host which is down,
+        shelved, soft deleted, resizing or already being deleted) goes
+        through the same path as delete(), one at a time.
+        """
+        for instance in instances:
+            if not self.skip_policy_check:
+                check_policy(context, 'delete', instance)
+            if instance.locked and not context.is_admin:
+                raise exception.InstanceIsLocked(instance_uuid=instance.uuid)
+            self._validate_cell(instance, 'delete')
+
+        by_host = collections.OrderedDict()
+        for instance in instances:
+            if instance.disable_terminate:
+                LOG.info(_LI('instance termination disabled'),
+                         instance=instance)
+            elif self.cell_type != 'api' and self._can_delete_in_batch(
+                    instance):
+                by_host.setdefault(instance.host, []).append(instance)
+            else:
+                self._delete_instance(context, instance)
+
+        batch = []
+        for host, host_instances in by_host.items():
+            try:
+                service, is_up = _SERVICES.get(context, self.servicegroup_api,
+                                               host)
+            except exception.ComputeHostNotFound:
+                is_up = False
+            if is_up:
+                batch.extend(host_instances)
+            else:
+                for instance in host_instances:
+                    self._delete_instance(context, instance)
+
+        if batch:
+            self._delete_batch(context, batch)
+
+    def _delete_batch(self, context, instances):
+        """Send a terminate cast for each of the instances, which are all
+        on hosts that are up.
+
+        Each instance gets its own quota reservation, handed to the
+        compute manager with its cast. If anything fails before an
+        instance is cast, its reservation is rolled back and its task
+        state restored.
+        """
+        fanout = _OrderedFanout(context, CONF.bulk_action_workers)
+        waits = [fanout.spawn(
+                    objects.BlockDeviceMappingList.get_by_instance_uuid,
+                    context, instance.uuid)
+                 for instance in instances]
+        try:
+            bdms = [wait() for wait in waits]
+        finally:
+            fanout.waitall()
+
+        deleting = []
+        reservations = []
+        sent = 0
+        try:
+            for instance, instance_bdms in zip(instances, bdms):
+                original_task_state = instance.task_state
+                try:
+                    instance.task_state = task_states.DELETING
+                    instance.progress = 0
+                    instance.save()
+                except exception.InstanceNotFound:
+                    # NOTE(comstud): Race condition. Instance already gone.
+                    continue
+                deleting.append((instance, instance_bdms,
+                                 original_task_state))
+                project_id, user_id = quotas_obj.ids_from_instance(context,
+                                                                   instance)
+                reservations.append(self._create_reservations(context,
+                        instance, original_task_state, project_id, user_id))
+
+            self._record_action_start_many(
+                    context, [item[0] for item in deleting],
+                    instance_actions.DELETE)
+
+            for (instance, instance_bdms, original_task_state), quotas in zip(
+                    deleting, reservations):
+                self._do_delete(context, instance, instance_bdms,
+                                reservations=quotas.reservations)
+                sent += 1
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._abort_delete_batch(deleting[sent:], reservations[sent:])
+
+    @staticmethod
+    def _abort_delete_batch(deleting, reservations):
+        """Undo the preparation of the instances which weren't cast."""
+        for index, (instance, bdms, original_task_state) in enumerate(
+                deleting):
+            try:
+                if index < len(reservations):
+                    reservations[index].rollback()
+                instance.task_state = original_task_state
+                instance.save()
+            except Exception:
+                LOG.exception(_LE('Failed to undo the deletion of an '
+                                  'instance which was not deleted'),
+                              instance=instance)
+
     @wrap_check_policy
     @check_instance_lock
     @check_instance_state(vm_state=[vm_states.SOFT_DELETED])
@@ -1923,12 +3689,21 @@ class API(base.Base):
         self.compute_rpcapi.start_instance(context, instance)
 
     def get(self, context, instance_id, want_objects=False,
-            expected_attrs=None):
-        """Get a single instance with the given instance_id."""
-        if not expected_attrs:
-            expected_attrs = []
-        expected_attrs.extend(['metadata', 'system_metadata',
-                               'security_groups', 'info_cache'])
+            expected_attrs=None, fields=None):
+        """Get a single instance with the given instance_id.
+
+        By default the metadata, system_metadata, security_groups and
+        info_cache of the instance are loaded along with expected_attrs.
+        If fields is given, exactly those optional attributes are loaded
+        instead, so fields=[] loads the instance row alone.
+        """
+        if fields is not None:
+            expected_attrs = list(fields)
+        else:
+            if not expected_attrs:
+                expected_attrs = []
+            expected_attrs.extend(['metadata', 'system_metadata',
+                                   'security_groups', 'info_cache'])
         # NOTE(ameade): we still need to support integer ids for ec2
         try:
             if uuidutils.is_uuid_like(instance_id):
@@ -1956,7 +3731,7 @@ class API(base.Base):
 
     def get_all(self, context, search_opts=None, limit=None, marker=None,
                 want_objects=False, expected_attrs=None, sort_keys=None,
-                sort_dirs=None):
+                sort_dirs=None, fields=None):
         """Get all instances filtered by one of the given parameters.
 
         If there is no filter and the context is an admin, it will retrieve
@@ -1970,6 +3745,11 @@ class API(base.Base):
         secondary sort ket, etc.). For each sort key, the associated sort
         direction is based on the list of sort directions in the 'sort_dirs'
         parameter.
+
+        The optional attributes loaded with each instance are chosen as in
+        get(), through expected_attrs or fields. The ip and ip6 filters
+        read the info_cache, which is loaded per instance if fields leaves
+        it out.
         """
 
         # TODO(bcwaldon): determine the best argument for target here
@@ -1981,16 +3761,166 @@ class API(base.Base):
         if not self.skip_policy_check:
             check_policy(context, "get_all", target)
 
-        if search_opts is None:
-            search_opts = {}
+        filters = self._get_instance_filters(context, search_opts or {})
+        if filters is None:
+            # We already know we can't match the filter, so return an
+            # empty list
+            return []
+
+        filter_ip = 'ip6' in filters or 'ip' in filters
+        if filter_ip and _IP_INDEX.enabled:
+            # The index turns the IP filter into a list of UUIDs, which the
+            # DB can apply along with the limit and marker.
+            filters = self._filter_by_ip_index(context, filters)
+            if filters is None:
+                return []
+            filter_ip = False
+
+        # IP address filtering cannot be applied at the DB layer, remove any DB
+        # limit so that it can be applied after the IP filter.
+        orig_limit = limit
+        if filter_ip and limit:
+            LOG.debug('Removing limit for DB query due to IP filter')
+            limit = None
 
+        inst_models = self._get_instances_by_filters(context, filters,
+                limit=limit, marker=marker, expected_attrs=expected_attrs,
+                sort_keys=sort_keys, sort_dirs=sort_dirs, fields=fields)
+
+        if filter_ip:
+            inst_models = self._ip_filter(inst_models, filters, orig_limit)
+
+        if want_objects:
+            return inst_models
+
+        # Convert the models to dictionaries
+        instances = []
+        for inst_model in inst_models:
+            instances.append(obj_base.obj_to_primitive(inst_model))
+
+        return instances
+
+    def get_all_iter(self, context, search_opts=None, cursor=None,
+                     page_size=None, want_objects=False, expected_attrs=None,
+                     sort_keys=None, sort_dirs=None, fields=None):
+        """Iterate over the instances get_all() would return.
+
+        Instances are fetched page_size (instance_list_page_size by
+        default) at a time and yielded one by one as (instance, cursor)
+        pairs, so the whole listing never has to be held in memory.
+
+        The cursor is an opaque string which records the sort keys and
+        the sort values of that instance. Passing it back, with the same
+        sort keys and directions, resumes the listing right after that
+        instance.
+
+        The policy check, the filters and the cursor are all validated
+        before this returns, so errors are raised by the call itself
+        rather than when the first instance is asked for.
+        """
+        target = {
+            'project_id': context.project_id,
+            'user_id': context.user_id,
+        }
+
+        if not self.skip_policy_check:
+            check_policy(context, "get_all", target)
+
+        filters = self._get_instance_filters(context, search_opts or {})
+        if filters is None:
+            return iter(())
+
+        page_size = page_size or CONF.instance_list_page_size
+        marker = None
+        if cursor:
+            marker = self._decode_list_cursor(cursor, sort_keys, sort_dirs)
+        filter_ip = 'ip6' in filters or 'ip' in filters
+        if filter_ip and _IP_INDEX.enabled:
+            filters = self._filter_by_ip_index(context, filters)
+            if filters is None:
+                return iter(())
+            filter_ip = False
+
+        return self._iter_instances(context, filters, filter_ip, marker,
+                                    page_size, want_objects, expected_attrs,
+                                    sort_keys, sort_dirs, fields)
+
+    def _iter_instances(self, context, filters, filter_ip, marker, page_size,
+                        want_objects, expected_attrs, sort_keys, sort_dirs,
+                        fields):
+        while True:
+            page = self._get_instances_by_filters(context, filters,
+                    limit=page_size, marker=marker,
+                    expected_attrs=expected_attrs, sort_keys=sort_keys,
+                    sort_dirs=sort_dirs, fields=fields)
+            if not page:
+                return
+            last_uuid = page[-1].uuid
+
+            matched = page
+            if filter_ip:
+                matched = self._ip_filter(page, filters, None)
+
+            for instance in matched:
+                cursor = self._encode_list_cursor(instance, sort_keys,
+                                                  sort_dirs)
+                if not want_objects:
+                    instance = obj_base.obj_to_primitive(instance)
+                yield instance, cursor
+
+            if len(page) < page_size:
+                return
+            marker = last_uuid
+
+    @staticmethod
+    def _sort_spec(values):
+        # Sort keys and directions may come as tuples, but always come
+        # back from a cursor as lists.
+        return list(values) if values is not None else None
+
+    @classmethod
+    def _encode_list_cursor(cls, instance, sort_keys, sort_dirs):
+        keys = sort_keys or ['created_at', 'id']
+        cursor = {'sort_keys': cls._sort_spec(sort_keys),
+                  'sort_dirs': cls._sort_spec(sort_dirs),
+                  'values': [instance[key] for key in keys],
+                  'uuid': instance.uuid}
+        return base64.urlsafe_b64encode(
+            jsonutils.dumps(cursor).encode('utf-8'))
+
+    @classmethod
+    def _decode_list_cursor(cls, cursor, sort_keys, sort_dirs):
+        """Return the marker to resume a listing from cursor.
+
+        The sort values are there for a DB API which can seek on them
+        directly. InstanceList.get_by_filters() only takes a marker, so
+        the last instance's UUID is what gets used for now.
+        """
+        try:
+            cursor = jsonutils.loads(base64.urlsafe_b64decode(str(cursor)))
+            marker = cursor['uuid']
+            cursor_keys = cls._sort_spec(cursor['sort_keys'])
+            cursor_dirs = cls._sort_spec(cursor['sort_dirs'])
+        except (TypeError, ValueError, KeyError):
+            raise exception.InvalidInput(reason=_('Invalid cursor'))
+        if (cursor_keys != cls._sort_spec(sort_keys) or
+                cursor_dirs != cls._sort_spec(sort_dirs)):
+            msg = _('The cursor was made for a different sort order')
+            raise exception.InvalidInput(reason=msg)
+        return marker
+
+    def _get_instance_filters(self, context, search_opts):
+        """Translate the search options of get_all() into DB filters.
+
+        Returns None if the options can't match any instance.
+        """
         LOG.debug("Searching by: %s" % str(search_opts))
 
         # Fixups for the DB call
         filters = {}
 
         def _remap_flavor_filter(flavor_id):
-            flavor = objects.Flavor.get_by_flavor_id(context, flavor_id)
+            flavor = _FLAVORS.get_by_flavor_id(context, flavor_id)
             filters['instance_type_id'] = flavor.id
 
         def _remap_fixed_ip_filter(fixed_ip):
@@ -2033,57 +3963,38 @@ class API(base.Base):
                     try:
                         remap_object(value)
 
-                    # We already know we can't match the filter, so
-                    # return an empty list
+                    # We already know we can't match the filter
                     except ValueError:
-                        return []
+                        return None
 
-        # IP address filtering cannot be applied at the DB layer, remove any DB
-        # limit so that it can be applied after the IP filter.
-        filter_ip = 'ip6' in filters or 'ip' in filters
-        orig_limit = limit
-        if filter_ip and limit:
-            LOG.debug('Removing limit for DB query due to IP filter')
-            limit = None
+        return filters
 
-        inst_models = self._get_instances_by_filters(context, filters,
-                limit=limit, marker=marker, expected_attrs=expected_attrs,
-                sort_keys=sort_keys, sort_dirs=sort_dirs)
+    def _filter_by_ip_index(self, context, filters):
+        """Replace the ip and ip6 filters with a uuid filter using the IP
+        index.
 
-        if filter_ip:
-            inst_models = self._ip_filter(inst_models, filters, orig_limit)
-
-        if want_objects:
-            return inst_models
-
-        # Convert the models to dictionaries
-        instances = []
-        for inst_model in inst_models:
-            instances.append(obj_base.obj_to_primitive(inst_model))
-
-        return instances
+        Returns None if no instance has a matching address.
+        """
+        def _load(other_filters):
+            return self._get_instances_by_filters(context, other_filters,
+                                                  fields=['info_cache'])
+
+        uuids = _IP_INDEX.search(context, filters, _load)
+        if not uuids:
+            return None
+        filters = {key: value for key, value in filters.items()
+                   if key not in ('ip', 'ip6')}
+        filters['uuid'] = sorted(uuids)
+        return filters
 
     @staticmethod
     def _ip_filter(inst_models, filters, limit):
-        ipv4_f = re.compile(str(filters.get('ip')))
-        ipv6_f = re.compile(str(filters.get('ip6')))
-
-        def _match_instance(instance):
-            nw_info = compute_utils.get_nw_info_for_instance(instance)
-            for vif in nw_info:
-                for fixed_ip in vif.fixed_ips():
-                    address = fixed_ip.get('address')
-                    if not address:
-                        continue
-                    version = fixed_ip.get('version')
-                    if ((version == 4 and ipv4_f.match(address)) or
-                        (version == 6 and ipv6_f.match(address))):
-                        return True
-            return False
+        ipv4_f = _ip_matcher(filters.get('ip'))
+        ipv6_f = _ip_matcher(filters.get('ip6'))
 
         result_objs = []
         for instance in inst_models:
-            if _match_instance(instance):
+            if _instance_has_ip(instance, ipv4_f, ipv6_f):
                 result_objs.append(instance)
                 if limit and len(result_objs) == limit:
                     break
@@ -2091,17 +4002,23 @@ class API(base.Base):
 
     def _get_instances_by_filters(self, context, filters,
                                   limit=None, marker=None, expected_attrs=None,
-                                  sort_keys=None, sort_dirs=None):
-        fields = ['metadata', 'system_metadata', 'info_cache',
-                  'security_groups']
-        if expected_attrs:
-            fields.extend(expected_attrs)
+                                  sort_keys=None, sort_dirs=None,
+                                  fields=None):
+        if fields is not None:
+            # Exactly what the caller asked for, which may be no joins at all
+            fields = list(fields)
+        else:
+            fields = ['metadata', 'system_metadata', 'info_cache',
+                      'security_groups']
+            if expected_attrs:
+                fields.extend(expected_attrs)
         return objects.InstanceList.get_by_filters(
             context, filters=filters, limit=limit, marker=marker,
             expected_attrs=fields, sort_keys=sort_keys, sort_dirs=sort_dirs)
 
     # NOTE(melwitt): We don't check instance lock for backup because lock is
     #                intended to prevent accidental change/delete of instances
+    @idempotent
     @wrap_check_policy
     @check_instance_cell
     @check_instance_state(vm_state=[vm_states.ACTIVE, vm_states.STOPPED,
@@ -2137,6 +4054,7 @@ class API(base.Base):
 
     # NOTE(melwitt): We don't check instance lock for snapshot because lock is
     #                intended to prevent accidental change/delete of instances
+    @idempotent
     @wrap_check_policy
     @check_instance_cell
     @check_instance_state(vm_state=[vm_states.ACTIVE, vm_states.STOPPED,
@@ -2188,7 +4106,7 @@ class API(base.Base):
         }
         image_ref = instance.image_ref
         sent_meta = compute_utils.get_image_metadata(
-            context, self.image_api, image_ref, instance)
+            context, self._image_cache, image_ref, instance)
 
         sent_meta['name'] = name
         sent_meta['is_public'] = False
@@ -2331,6 +4249,7 @@ class API(base.Base):
                                             block_device_info=None,
                                             reboot_type=reboot_type)
 
+    @idempotent
     @wrap_check_policy
     @check_instance_lock
     @check_instance_cell
@@ -2517,9 +4436,9 @@ class API(base.Base):
         """Calculate deltas required to reverse a prior upsizing
         quota adjustment.
         """
-        old_flavor = objects.Flavor.get_by_id(
+        old_flavor = _FLAVORS.get_by_id(
             context, migration_ref['old_instance_type_id'])
-        new_flavor = objects.Flavor.get_by_id(
+        new_flavor = _FLAVORS.get_by_id(
             context, migration_ref['new_instance_type_id'])
 
         return API._resize_quota_delta(context, new_flavor, old_flavor, -1, -1)
@@ -2571,6 +4490,7 @@ class API(base.Base):
         mig.status = 'finished'
         mig.create()
 
+    @idempotent
     @wrap_check_policy
     @check_instance_lock
     @check_instance_cell
@@ -2593,8 +4513,12 @@ class API(base.Base):
                       instance=instance)
             new_instance_type = current_instance_type
         else:
+            # NOTE(hewh): The target flavor is validated against its
+            # disabled and deleted state, so read it from the DB rather than
+            # the cache, and drop any cached copy which may be out of date.
             new_instance_type = flavors.get_flavor_by_flavor_id(
                     flavor_id, read_deleted="no")
+            _FLAVORS.invalidate(new_instance_type)
             if (new_instance_type.get('root_gb') == 0 and
                 current_instance_type.get('root_gb') != 0):
                 reason = _('Resize to zero disk flavor is not allowed.')
@@ -2986,7 +4910,8 @@ class API(base.Base):
     @wrap_check_policy
     def get_lock(self, context, instance):
         """Return the boolean state of given instance's lock."""
-        return self.get(context, instance.uuid)['locked']
+        return self.get(context, instance.uuid, want_objects=True,
+                        fields=[]).locked
 
     @wrap_check_policy
     @check_instance_lock
@@ -3262,8 +5187,11 @@ class API(base.Base):
         """
         LOG.debug('vm evacuation scheduled', instance=instance)
         inst_host = instance.host
-        service = objects.Service.get_by_compute_host(context, inst_host)
-        if self.servicegroup_api.service_is_up(service):
+        # NOTE(hewh): Rebuilding an instance whose host is still running it
+        # would leave two copies behind, so don't go by a stale snapshot.
+        service, is_up = _SERVICES.get(context, self.servicegroup_api,
+                                       inst_host, force_refresh=True)
+        if is_up:
             LOG.error(_LE('Instance compute service state on %s '
                           'expected to be down, but it was up.'), inst_host)
             raise exception.ComputeServiceInUse(host=inst_host)
@@ -3348,10 +5276,11 @@ class HostAPI(base.Base):
 
     def _assert_host_exists(self, context, host_name, must_be_up=False):
         """Raise HostNotFound if compute host doesn't exist."""
-        service = objects.Service.get_by_compute_host(context, host_name)
+        service, is_up = _SERVICES.get(context, self.servicegroup_api,
+                                       host_name)
         if not service:
             raise exception.HostNotFound(host=host_name)
-        if must_be_up and not self.servicegroup_api.service_is_up(service):
+        if must_be_up and not is_up:
             raise exception.ComputeServiceUnavailable(host=host_name)
         return service['host']
 
@@ -3360,14 +5289,14 @@ class HostAPI(base.Base):
         """Sets the specified host's ability to accept new instances."""
         host_name = self._assert_host_exists(context, host_name)
         payload = {'host_name': host_name, 'enabled': enabled}
-        compute_utils.notify_about_host_update(context,
-                                               'set_enabled.start',
-                                               payload)
+        _notify_about_host_update(context,
+                                  'set_enabled.start',
+                                  payload)
         result = self.rpcapi.set_host_enabled(context, enabled=enabled,
                 host=host_name)
-        compute_utils.notify_about_host_update(context,
-                                               'set_enabled.end',
-                                               payload)
+        _notify_about_host_update(context,
+                                  'set_enabled.end',
+                                  payload)
         return result
 
     def get_host_uptime(self, context, host_name):
@@ -3381,14 +5310,14 @@ class HostAPI(base.Base):
         """Reboots, shuts down or powers up the host."""
         host_name = self._assert_host_exists(context, host_name)
         payload = {'host_name': host_name, 'action': action}
-        compute_utils.notify_about_host_update(context,
-                                               'power_action.start',
-                                               payload)
+        _notify_about_host_update(context,
+                                  'power_action.start',
+                                  payload)
         result = self.rpcapi.host_power_action(context, action=action,
                 host=host_name)
-        compute_utils.notify_about_host_update(context,
-                                               'power_action.end',
-                                               payload)
+        _notify_about_host_update(context,
+                                  'power_action.end',
+                                  payload)
         return result
 
     @wrap_exception()
@@ -3398,14 +5327,14 @@ class HostAPI(base.Base):
         """
         host_name = self._assert_host_exists(context, host_name)
         payload = {'host_name': host_name, 'mode': mode}
-        compute_utils.notify_about_host_update(context,
-                                               'set_maintenance.start',
-                                               payload)
+        _notify_about_host_update(context,
+                                  'set_maintenance.start',
+                                  payload)
         result = self.rpcapi.host_maintenance_mode(context,
                 host_param=host_name, mode=mode, host=host_name)
-        compute_utils.notify_about_host_update(context,
-                                               'set_maintenance.end',
-                                               payload)
+        _notify_about_host_update(context,
+                                  'set_maintenance.end',
+                                  payload)
         return result
 
     def service_get_all(self, context, filters=None, set_zones=False):
@@ -3449,8 +5378,13 @@ class HostAPI(base.Base):
         For compute services, this stops new builds and migrations going to
         the host.
         """
-        return self._service_update(context, host_name, binary,
-                                    params_to_update)
+        service = self._service_update(context, host_name, binary,
+                                       params_to_update)
+        if 'disabled' in params_to_update:
+            # Zones only count as available while they have enabled services
+            _AVAILABILITY_ZONES.reset()
+        _SERVICES.reset()
+        return service
 
     def _service_delete(self, context, service_id):
         """Performs the actual Service deletion operation."""
@@ -3459,6 +5393,8 @@ class HostAPI(base.Base):
     def service_delete(self, context, service_id):
         """Deletes the specified service."""
         self._service_delete(context, service_id)
+        _AVAILABILITY_ZONES.reset()
+        _SERVICES.reset()
 
     def instance_get_all_by_host(self, context, host_name):
         """Return all instances on the given host."""
@@ -3523,6 +5459,8 @@ class AggregateAPI(base.Base):
             aggregate.metadata = {'availability_zone': availability_zone}
         aggregate.create()
         self.scheduler_client.update_aggregates(context, [aggregate])
+        if availability_zone:
+            _AVAILABILITY_ZONES.reset()
         return aggregate
 
     def get_aggregate(self, context, aggregate_id):
@@ -3549,6 +5487,10 @@ class AggregateAPI(base.Base):
         # which stored availability_zones and host need to be reset
         if values.get('availability_zone'):
             availability_zones.reset_cache()
+            _AVAILABILITY_ZONES.move_hosts(aggregate.hosts,
+                                           values['availability_zone'])
+        elif 'availability_zone' in values:
+            _AVAILABILITY_ZONES.reset()
         return aggregate
 
     @wrap_exception()
@@ -3563,15 +5505,19 @@ class AggregateAPI(base.Base):
         # which stored availability_zones and host need to be reset
         if metadata and metadata.get('availability_zone'):
             availability_zones.reset_cache()
+            _AVAILABILITY_ZONES.move_hosts(aggregate.hosts,
+                                           metadata['availability_zone'])
+        elif metadata and 'availability_zone' in metadata:
+            _AVAILABILITY_ZONES.reset()
         return aggregate
 
     @wrap_exception()
     def delete_aggregate(self, context, aggregate_id):
         """Deletes the aggregate."""
         aggregate_payload = {'aggregate_id': aggregate_id}
-        compute_utils.notify_about_aggregate_update(context,
-                                                    "delete.start",
-                                                    aggregate_payload)
+        _notify_about_aggregate_update(context,
+                                       "delete.start",
+                                       aggregate_payload)
         aggregate = objects.Aggregate.get_by_id(context, aggregate_id)
         if len(aggregate.hosts) > 0:
             msg = _("Host aggregate is not empty")
@@ -3579,9 +5525,9 @@ class AggregateAPI(base.Base):
                 aggregate_id=aggregate_id, reason=msg)
         aggregate.destroy()
         self.scheduler_client.delete_aggregate(context, aggregate)
-        compute_utils.notify_about_aggregate_update(context,
-                                                    "delete.end",
-                                                    aggregate_payload)
+        _notify_about_aggregate_update(context,
+                                       "delete.end",
+                                       aggregate_payload)
 
     def is_safe_to_update_az(self, context, metadata, aggregate,
                              hosts=None,
@@ -3598,14 +5544,16 @@ class AggregateAPI(base.Base):
         """
         if 'availability_zone' in metadata:
             _hosts = hosts or aggregate.hosts
-            zones, not_zones = availability_zones.get_availability_zones(
-                context, with_hosts=True)
+            # NOTE(hewh): This guards an admin change, so don't trust a map
+            # which another API worker may have made stale. One rebuild per
+            # call still turns the per-host checks into lookups.
+            _AVAILABILITY_ZONES.available_zones(context, refresh=True)
             for host in _hosts:
                 # NOTE(sbauza): Host can only be in one AZ, so let's take only
                 #               the first element
-                host_azs = [az for (az, az_hosts) in zones
-                            if host in az_hosts
-                            and az != CONF.internal_service_availability_zone]
+                host_azs = [az for az in
+                            _AVAILABILITY_ZONES.host_zones(context, host)
+                            if az != CONF.internal_service_availability_zone]
                 host_az = host_azs.pop()
                 if host_azs:
                     LOG.warning(_LW("More than 1 AZ for host %s"), host)
@@ -3665,22 +5613,30 @@ class AggregateAPI(base.Base):
                 self._raise_invalid_aggregate_exc(action_name,
                     aggregate_id, msg)
 
-    def _update_az_cache_for_host(self, context, host_name, aggregate_meta):
+    def _update_az_cache_for_host(self, context, host_name, aggregate_meta,
+                                  added=False):
         # Update the availability_zone cache to avoid getting wrong
         # availability_zone in cache retention time when add/remove
         # host to/from aggregate.
         if aggregate_meta and aggregate_meta.get('availability_zone'):
             availability_zones.update_host_availability_zone_cache(context,
                                                                    host_name)
+            if added:
+                _AVAILABILITY_ZONES.move_hosts(
+                    [host_name], aggregate_meta['availability_zone'])
+            else:
+                # NOTE(hewh): Where the host ends up depends on its other
+                # aggregates, so rebuild rather than guess.
+                _AVAILABILITY_ZONES.reset()
 
     @wrap_exception()
     def add_host_to_aggregate(self, context, aggregate_id, host_name):
         """Adds the host to an aggregate."""
         aggregate_payload = {'aggregate_id': aggregate_id,
                              'host_name': host_name}
-        compute_utils.notify_about_aggregate_update(context,
-                                                    "addhost.start",
-                                                    aggregate_payload)
+        _notify_about_aggregate_update(context,
+                                       "addhost.start",
+                                       aggregate_payload)
         # validates the host; ComputeHostNotFound is raised if invalid
         objects.Service.get_by_compute_host(context, host_name)
 
@@ -3692,14 +5648,15 @@ class AggregateAPI(base.Base):
 
         aggregate.add_host(host_name)
         self.scheduler_client.update_aggregates(context, [aggregate])
-        self._update_az_cache_for_host(context, host_name, aggregate.metadata)
+        self._update_az_cache_for_host(context, host_name, aggregate.metadata,
+                                       added=True)
         # NOTE(jogo): Send message to host to support resource pools
         self.compute_rpcapi.add_aggregate_host(context,
                 aggregate=aggregate, host_param=host_name, host=host_name)
         aggregate_payload.update({'name': aggregate['name']})
-        compute_utils.notify_about_aggregate_update(context,
-                                                    "addhost.end",
-                                                    aggregate_payload)
+        _notify_about_aggregate_update(context,
+                                       "addhost.end",
+                                       aggregate_payload)
         return aggregate
 
     @wrap_exception()
@@ -3707,9 +5664,9 @@ class AggregateAPI(base.Base):
         """Removes host from the aggregate."""
         aggregate_payload = {'aggregate_id': aggregate_id,
                              'host_name': host_name}
-        compute_utils.notify_about_aggregate_update(context,
-                                                    "removehost.start",
-                                                    aggregate_payload)
+        _notify_about_aggregate_update(context,
+                                       "removehost.start",
+                                       aggregate_payload)
         # validates the host; ComputeHostNotFound is raised if invalid
         objects.Service.get_by_compute_host(context, host_name)
         aggregate = objects.Aggregate.get_by_id(context, aggregate_id)
@@ -3718,9 +5675,9 @@ class AggregateAPI(base.Base):
         self._update_az_cache_for_host(context, host_name, aggregate.metadata)
         self.compute_rpcapi.remove_aggregate_host(context,
                 aggregate=aggregate, host_param=host_name, host=host_name)
-        compute_utils.notify_about_aggregate_update(context,
-                                                    "removehost.end",
-                                                    aggregate_payload)
+        _notify_about_aggregate_update(context,
+                                       "removehost.end",
+                                       aggregate_payload)
         return aggregate
 
 
@@ -3842,6 +5799,11 @@ class SecurityGroupAPI(base.Base, security_group_base.SecurityGroupBase):
     # The nova security group api does not use a uuid for the id.
     id_is_uuid = False
 
+    # Projects which are known to have their default security group. A
+    # project never loses its default group through this API, so once it
+    # is in here ensure_default() doesn't need to go to the DB again.
+    _projects_with_default = set()
+
     def __init__(self, skip_policy_check=False, **kwargs):
         super(SecurityGroupAPI, self).__init__(**kwargs)
         self.skip_policy_check = skip_policy_check
@@ -3882,7 +5844,26 @@ class SecurityGroupAPI(base.Base, security_group_base.SecurityGroupBase):
 
         :param context: the security context
         """
+        project_id = context.project_id
+        if project_id is not None and project_id in \
+                self._projects_with_default:
+            return
         self.db.security_group_ensure_default(context)
+        if project_id is not None:
+            self._projects_with_default.add(project_id)
+
+    @classmethod
+    def forget_default(cls, project_id=None):
+        """Make ensure_default() check the DB again.
+
+        Only the given project is forgotten, or every project if none is
+        given. Call this when a project's default security group may have
+        been removed behind the API's back, e.g. by project cleanup.
+        """
+        if project_id is None:
+            cls._projects_with_default.clear()
+        else:
+            cls._projects_with_default.discard(project_id)
 
     def create_security_group(self, context, name, description):
         quotas = objects.Quotas(context)
@@ -3941,6 +5922,10 @@ class SecurityGroupAPI(base.Base, security_group_base.SecurityGroupBase):
             elif id:
                 return self.db.security_group_get(context, id)
         except exception.NotFound as exp:
+            if name == 'default':
+                # The default group went away behind our back, so make
+                # the next ensure_default() recreate it.
+                self.forget_default(context.project_id)
             if map_exception:
                 msg = exp.format_message()
                 self.raise_not_found(msg)